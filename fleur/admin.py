@@ -1,7 +1,8 @@
 # fleur/admin.py
 from django.contrib import admin
 from .models import Category, Product, Order, Payment, OrderStatus, PaymentStatus,Slot
-from .models import HomeContent
+from .models import HomeContent, VendJob, VendJobStatus
+from django.utils import timezone
 
 
 @admin.register(Category)
@@ -102,3 +103,22 @@ class PaymentAdmin(admin.ModelAdmin):
     def remaining_display(self, obj):
         return obj.remaining()
     remaining_display.short_description = "Reste à payer (DA)"
+
+
+@admin.register(VendJob)
+class VendJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "order", "channel", "status", "attempts", "last_error", "updated_at")
+    list_filter = ("status",)
+    search_fields = ("id", "order__id")
+    readonly_fields = ("created_at", "updated_at", "locked_at")
+    ordering = ("-created_at",)
+
+    actions = ["retry"]
+
+    def retry(self, request, queryset):
+        # RUNNING: un worker est dessus (requeue_stale la reprendra s'il est mort)
+        updated = queryset.exclude(status__in=(VendJobStatus.DONE, VendJobStatus.RUNNING)).update(
+            status=VendJobStatus.QUEUED, attempts=0, run_after=timezone.now(), locked_at=None,
+        )
+        self.message_user(request, f"{updated} ouverture(s) remise(s) en file.")
+    retry.short_description = "Relancer l'ouverture"
@@ -1,38 +1,147 @@
 # fleur/api.py
+from decimal import Decimal, InvalidOperation
 from django.http import JsonResponse, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, Value, When
 import json
-from .models import Payment, PaymentStatus, OrderStatus
+from .models import Order, Payment, PaymentEvent, PaymentStatus, OrderStatus
+from .payment_notify import notify_payment
 
 API_KEY = "dev-secret"  # mets-la dans settings si tu veux
+MAX_BATCH_EVENTS = 500
 
+
+class _Duplicate(Exception):
+    pass
+
+
+def _apply_event(payment_id, amount, event="", event_id=None):
+    """
+    Crédite un billet sur un paiement (à appeler dans une transaction).
+    Le crédit et le passage à SUCCEEDED se font dans UN seul UPDATE côté base
+    (F() + Case): pas de lecture-modification-écriture en Python, donc deux
+    producteurs concurrents (caméra + bridge, retry) ne perdent aucun
+    incrément et ne basculent pas le statut deux fois. L'UPDATE verrouille la
+    ligne du paiement jusqu'au commit; les autres paiements ne sont pas bloqués.
+    `event_id` (optionnel) = clé d'idempotence: un même évènement rejoué
+    (retry du bridge, replay de flotte) n'est crédité qu'une fois.
+    Retourne un dict résultat, sans lever d'exception.
+    """
+    try:
+        amount = Decimal(str(amount))
+    except (InvalidOperation, ValueError, TypeError):
+        return {"ok": False, "error": "invalid amount"}
+    if not amount.is_finite() or amount <= 0:
+        return {"ok": False, "error": "invalid amount"}
+    try:
+        payment_id = int(payment_id)
+    except (ValueError, TypeError):
+        return {"ok": False, "error": "payment not found"}
+
+    try:
+        with transaction.atomic():
+            updated = (
+                Payment.objects
+                .filter(pk=payment_id)
+                .exclude(status=PaymentStatus.SUCCEEDED)
+                .update(
+                    amount_inserted=F("amount_inserted") + amount,
+                    # les colonnes à droite sont les valeurs AVANT l'UPDATE
+                    status=Case(
+                        When(amount_inserted__gte=F("amount_due") - amount, then=Value(PaymentStatus.SUCCEEDED)),
+                        default=F("status"),
+                    ),
+                )
+            )
+            if updated and event_id:
+                try:
+                    PaymentEvent.objects.create(event_id=event_id, payment_id=payment_id,
+                                                amount=amount, event=event or "")
+                except IntegrityError:
+                    raise _Duplicate()   # annule aussi le crédit (savepoint)
+    except _Duplicate:
+        updated = 0
+        duplicate = True
+    else:
+        duplicate = False
+
+    row = Payment.objects.filter(pk=payment_id).values("status", "order_id").first()
+    if row is None:
+        return {"ok": False, "error": "payment not found"}
+    completed = row["status"] == PaymentStatus.SUCCEEDED
+    if duplicate:
+        return {"ok": True, "status": "duplicate", "completed": completed}
+    if not updated:
+        # Idempotence: si déjà payé, on confirme seulement
+        return {"ok": True, "status": "already_paid", "completed": True}
+
+    if completed:
+        Order.objects.filter(pk=row["order_id"]).exclude(status=OrderStatus.PAID).update(status=OrderStatus.PAID)
+    # réveille les écrans en long-poll sur ce paiement, une fois le crédit visible
+    transaction.on_commit(lambda: notify_payment(payment_id))
+    return {"ok": True, "status": "applied", "completed": completed}
+
+
+def _apply_event_atomic(payment_id, amount, event="", event_id=None):
+    with transaction.atomic():
+        return _apply_event(payment_id, amount, event, event_id)
+
+
+def _apply_events(events):
+    results = []
+    with transaction.atomic():
+        for ev in events:
+            if not isinstance(ev, dict) or not ev.get("event_id"):
+                results.append({"event_id": ev.get("event_id") if isinstance(ev, dict) else None,
+                                "ok": False, "error": "event_id required"})
+                continue
+            with transaction.atomic():
+                res = _apply_event(ev.get("payment_id"), ev.get("amount", 0), ev.get("event", ""), ev["event_id"])
+            results.append({"event_id": ev["event_id"], **res})
+    return results
+
+
+# Vues async (ASGI): la transaction tourne dans le thread ORM via sync_to_async,
+# la boucle reste libre pour les long-polls de payment_status.
 @csrf_exempt
-def payment_insert_event(request):
+async def payment_insert_event(request):
     # Sécurité simple
     if request.headers.get("X-Api-Key") != API_KEY:
         return HttpResponseForbidden("bad key")
 
     data = json.loads(request.body.decode("utf-8"))
-    payment_id = data.get("payment_id")
-    amount = int(data.get("amount", 0))
+    res = await sync_to_async(_apply_event_atomic)(data.get("payment_id"), data.get("amount", 0),
+                                                   data.get("event", ""), data.get("event_id"))
+    if not res["ok"]:
+        status = 404 if res["error"] == "payment not found" else 400
+        return JsonResponse({"ok": False, "error": res["error"]}, status=status)
+    return JsonResponse({"ok": True, "completed": res["completed"], "duplicate": res["status"] == "duplicate"})
+
+
+@csrf_exempt
+async def payment_insert_events(request):
+    """
+    Ingestion groupée (outbox du bridge, rejeu de flotte).
+    Body JSON: {"events": [{"event_id": "...", "payment_id": 42, "amount": 500, "event": "bill_inserted"}, ...]}
+    Tous les évènements sont appliqués dans une seule transaction (un savepoint
+    par évènement); la réponse donne un résultat par évènement, dans l'ordre.
+    """
+    if request.headers.get("X-Api-Key") != API_KEY:
+        return HttpResponseForbidden("bad key")
+    if request.method != "POST":
+        return JsonResponse({"ok": False, "error": "POST required"}, status=405)
 
     try:
-        p = Payment.objects.select_related("order").get(pk=payment_id)
-    except Payment.DoesNotExist:
-        return JsonResponse({"ok": False, "error": "payment not found"}, status=404)
-
-    # Idempotence: si déjà payé, on confirme seulement
-    if p.status == PaymentStatus.SUCCEEDED:
-        return JsonResponse({"ok": True, "completed": True})
-
-    # Incrémente
-    p.amount_inserted = (p.amount_inserted or 0) + amount
-    if p.amount_inserted >= p.amount_due:
-        p.status = PaymentStatus.SUCCEEDED
-        p.order.status = OrderStatus.PAID
-        p.order.save(update_fields=["status"])
-        p.save(update_fields=["amount_inserted", "status"])
-        return JsonResponse({"ok": True, "completed": True})
-
-    p.save(update_fields=["amount_inserted"])
-    return JsonResponse({"ok": True, "completed": False})
+        data = json.loads(request.body.decode("utf-8"))
+        events = data["events"]
+        if not isinstance(events, list):
+            raise TypeError
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"ok": False, "error": "body must be {\"events\": [...]}"}, status=400)
+    if len(events) > MAX_BATCH_EVENTS:
+        return JsonResponse({"ok": False, "error": f"max {MAX_BATCH_EVENTS} events per batch"}, status=413)
+
+    results = await sync_to_async(_apply_events)(events)
+    return JsonResponse({"ok": True, "results": results})
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FleurConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'fleur'
+
+    def ready(self):
+        from . import catalogue_cache, search  # noqa: F401  (signaux: cache catalogue, index de recherche)
@@ -0,0 +1,116 @@
+# fleur/catalogue_cache.py
+"""
+Cache des pages catalogue publiques (home, boutique, mes bouquets).
+
+Ce sont les pages d'attente du kiosque: le HTML rendu est gardé dans le cache
+Django, sous une clé qui contient la "version catalogue" (+ vue, catégorie,
+recherche). Toute sauvegarde / suppression de Product, Category, Slot ou
+HomeContent change la version (signaux post_save / post_delete, au commit
+de la transaction), donc les anciennes entrées ne sont plus jamais lues. Les réponses portent ETag et
+Last-Modified: le navigateur revalide et reçoit un 304 sans rendu.
+
+Cas courant: zéro requête SQL (une lecture de cache pour la version, une pour
+la page). Les .update() en masse ne passent pas par les signaux: appeler
+bump_catalogue_version() après.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .models import Category, HomeContent, Product, Slot
+
+VERSION_KEY = "catalogue:version"
+PAGE_TTL = 24 * 3600   # s; l'invalidation se fait par la version, le TTL ne sert qu'au ménage
+
+
+def catalogue_version() -> int:
+    """Horodatage (ms) de la dernière modification du catalogue."""
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(VERSION_KEY, version, None)
+        version = cache.get(VERSION_KEY, version)
+    return version
+
+
+def bump_catalogue_version(**kwargs):
+    version = max(int(time.time() * 1000), (cache.get(VERSION_KEY) or 0) + 1)
+    cache.set(VERSION_KEY, version, None)
+    return version
+
+
+def _bump_on_commit(**kwargs):
+    # Après le commit seulement: une requête servie avant le commit rendrait
+    # les anciennes données sous la nouvelle version et les garderait PAGE_TTL.
+    transaction.on_commit(bump_catalogue_version)
+
+
+for _model in (Product, Category, Slot, HomeContent):
+    receiver(post_save, sender=_model, dispatch_uid=f"catalogue_save_{_model.__name__}")(_bump_on_commit)
+    receiver(post_delete, sender=_model, dispatch_uid=f"catalogue_delete_{_model.__name__}")(_bump_on_commit)
+
+
+def _has_messages(request) -> bool:
+    # len() charge les messages (cookie) sans les marquer comme lus
+    return bool(len(get_messages(request)))
+
+
+def _page_key(request, name, kwargs):
+    """Clé de cache de la page (calculée une fois par requête); pose aussi request._catalogue_etag."""
+    if not hasattr(request, "_catalogue_key"):
+        parts = [name] + [f"{k}={v}" for k, v in sorted(kwargs.items())] + [request.GET.urlencode()]
+        digest = hashlib.md5("|".join(parts).encode("utf-8")).hexdigest()
+        version = catalogue_version()
+        request._catalogue_version = version
+        request._catalogue_etag = f"{version}-{digest[:12]}"
+        request._catalogue_key = f"catalogue:page:{version}:{digest}"
+    return request._catalogue_key
+
+
+def catalogue_page(view):
+    """
+    Décorateur des vues catalogue: 304 si l'ETag du client est à jour, sinon
+    HTML depuis le cache, sinon rendu normal mis en cache. Une page avec des
+    messages flash en attente n'est ni servie depuis le cache ni mise en cache.
+    """
+    name = view.__name__
+
+    def etag(request, *args, **kwargs):
+        if _has_messages(request):
+            return None
+        _page_key(request, name, kwargs)
+        return request._catalogue_etag
+
+    def last_modified(request, *args, **kwargs):
+        if _has_messages(request):
+            return None
+        _page_key(request, name, kwargs)
+        return datetime.fromtimestamp(request._catalogue_version / 1000, tz=timezone.utc)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != "GET" or _has_messages(request):
+            return view(request, *args, **kwargs)
+        key = _page_key(request, name, kwargs)
+        html = cache.get(key)
+        if html is not None:
+            resp = HttpResponse(html)
+        else:
+            resp = view(request, *args, **kwargs)
+            if resp.status_code == 200 and not resp.streaming:
+                cache.set(key, resp.content, PAGE_TTL)
+        # le navigateur garde la page mais revalide à chaque affichage (304)
+        patch_cache_control(resp, no_cache=True)
+        return resp
+
+    return condition(etag_func=etag, last_modified_func=last_modified)(wrapper)
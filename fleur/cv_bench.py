@@ -0,0 +1,201 @@
+# cv_bench.py
+# -----------------------------------------
+# Banc d'essai hors-ligne du classifieur de billets (sans caméra).
+# Rejoue des images / vidéos étiquetées dans preprocess -> classify_bill et
+# sort un rapport JSON:
+#   - latences par étape (p50/p90/p99/max, ms) et frames/s
+#   - matrice de confusion par montant au seuil CONF_THRESHOLD
+#   - précision / rappel par montant pour une série de seuils
+#
+# ETIQUETTES (dans l'ordre):
+#   --label 1000              -> force l'étiquette de toutes les entrées
+#   dossier parent "500/", "1000/", "2000/", "none/" (ou "0/", "vide/")
+#   préfixe du fichier "500_xxx.jpg", "none_xxx.mp4"
+#   sinon: "unlabelled" (compte pour la latence, pas pour la précision)
+#
+# LANCER (depuis fleur/, mêmes variables d'env que cv_bill_server.py):
+#   python cv_bench.py bench/ ../videos/ --every 5 --out orb_3000.json
+#   set USE_SIFT=1 && python cv_bench.py bench/ --out sift.json
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2 # type: ignore
+import numpy as np
+
+import cv_bill_server as cv
+
+IMAGE_EXT = {".jpg", ".jpeg", ".png", ".bmp"}
+VIDEO_EXT = {".mp4", ".avi", ".mov", ".mkv"}
+NONE_LABELS = {"none", "0", "vide", "empty"}
+STAGES = ["preprocess", "roi", "detect", "match", "rematch", "homography", "total"]
+
+def parse_label(token):
+    token = (token or "").lower()
+    if token in NONE_LABELS:
+        return "none"
+    if token.isdigit() and int(token) in cv.ALLOWED_AMOUNTS:
+        return int(token)
+    return None
+
+def label_for(path, forced=None):
+    if forced is not None:
+        return forced
+    parent = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    lbl = parse_label(parent)
+    if lbl is None:
+        lbl = parse_label(os.path.basename(path).split("_")[0].split(".")[0])
+    return lbl if lbl is not None else "unlabelled"
+
+def iter_inputs(paths):
+    for p in paths:
+        if os.path.isdir(p):
+            for root, dirs, files in os.walk(p):
+                dirs.sort()
+                for f in sorted(files):
+                    if os.path.splitext(f)[1].lower() in IMAGE_EXT | VIDEO_EXT:
+                        yield os.path.join(root, f)
+        else:
+            yield p
+
+def iter_frames(path, every=1, max_frames=None):
+    """(nom, frame_bgr) pour une image ou toutes les `every` frames d'une vidéo."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXT:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"[bench] illisible: {path}", file=sys.stderr)
+            return
+        yield path, img
+        return
+    cap = cv2.VideoCapture(path)
+    idx = kept = 0
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            if idx % every == 0:
+                yield f"{path}#{idx}", frame
+                kept += 1
+                if max_frames and kept >= max_frames:
+                    break
+            idx += 1
+    finally:
+        cap.release()
+
+def percentiles(values):
+    if not values:
+        return None
+    a = np.asarray(values, dtype=np.float64)
+    return {
+        "p50": round(float(np.percentile(a, 50)), 2),
+        "p90": round(float(np.percentile(a, 90)), 2),
+        "p99": round(float(np.percentile(a, 99)), 2),
+        "max": round(float(a.max()), 2),
+        "mean": round(float(a.mean()), 2),
+    }
+
+def predicted(rec, threshold):
+    return rec["amount"] if rec["amount"] in cv.ALLOWED_AMOUNTS and rec["score"] >= threshold else "none"
+
+def confusion(records, threshold):
+    classes = [str(a) for a in cv.ALLOWED_AMOUNTS] + ["none"]
+    matrix = {t: {p: 0 for p in classes} for t in classes}
+    for rec in records:
+        if rec["label"] == "unlabelled":
+            continue
+        matrix[str(rec["label"])][str(predicted(rec, threshold))] += 1
+    return matrix
+
+def precision_recall(records, threshold):
+    out = {}
+    labelled = [r for r in records if r["label"] != "unlabelled"]
+    for amt in cv.ALLOWED_AMOUNTS:
+        tp = sum(1 for r in labelled if r["label"] == amt and predicted(r, threshold) == amt)
+        fp = sum(1 for r in labelled if r["label"] != amt and predicted(r, threshold) == amt)
+        fn = sum(1 for r in labelled if r["label"] == amt and predicted(r, threshold) != amt)
+        out[str(amt)] = {
+            "tp": tp, "fp": fp, "fn": fn,
+            "precision": round(tp / (tp + fp), 4) if tp + fp else None,
+            "recall": round(tp / (tp + fn), 4) if tp + fn else None,
+        }
+    return out
+
+def run(paths, forced_label=None, every=1, max_frames=None, thresholds=None):
+    cv.get_templates_bank()
+    # 1er appel hors statistiques (allocations OpenCV/FLANN)
+    cv.classify_bill(np.zeros((cv.FRAME_HEIGHT, cv.FRAME_WIDTH, 3), dtype=np.uint8))
+    records = []
+    elapsed = 0.0
+    for path in iter_inputs(paths):
+        label = label_for(path, forced_label)
+        for name, frame in iter_frames(path, every, max_frames):
+            timings = {}
+            t0 = time.perf_counter()
+            amt, score, tpl = cv.classify_bill(frame, timings)
+            elapsed += time.perf_counter() - t0
+            records.append({
+                "input": name, "label": label, "amount": amt,
+                "score": round(float(score), 4), "template": tpl,
+                "timings_ms": {k: round(v, 2) for k, v in timings.items()},
+            })
+
+    thresholds = thresholds or [cv.CONF_THRESHOLD]
+    return {
+        "settings": {
+            "use_sift": cv.USE_SIFT, "features": cv.FEATURES, "ratio_test": cv.RATIO_TEST,
+            "min_matches": cv.MIN_MATCHES, "ransac_reproj": cv.RANSAC_REPROJ,
+            "conf_threshold": cv.CONF_THRESHOLD, "index_knn": cv.INDEX_KNN, "index_top_k": cv.INDEX_TOP_K,
+            "rematch_min_votes": cv.REMATCH_MIN_VOTES,
+            "roi": cv.ROI_ENABLED, "pyramid_scales": cv.PYRAMID_SCALES,
+            "opencv": cv2.__version__,
+        },
+        "frames": len(records),
+        "labelled": sum(1 for r in records if r["label"] != "unlabelled"),
+        "fps": round(len(records) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            stage: percentiles([r["timings_ms"].get(stage, 0.0) for r in records]) for stage in STAGES
+        },
+        "confusion": confusion(records, cv.CONF_THRESHOLD),
+        "sweep": [
+            {"threshold": t, "per_amount": precision_recall(records, t)} for t in thresholds
+        ],
+        "records": records,
+    }
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark hors-ligne de classify_bill")
+    ap.add_argument("inputs", nargs="+", help="images, vidéos ou dossiers")
+    ap.add_argument("--label", help="étiquette forcée: 500|1000|2000|none")
+    ap.add_argument("--every", type=int, default=1, help="1 frame sur N pour les vidéos")
+    ap.add_argument("--max-frames", type=int, default=None, help="frames max par vidéo")
+    ap.add_argument("--thresholds", default="0.3,0.4,0.5,0.6,0.7,0.8,0.9",
+                    help="seuils CONF_THRESHOLD pour la courbe précision/rappel")
+    ap.add_argument("--no-records", action="store_true", help="n'écrit pas le détail par frame")
+    ap.add_argument("--out", help="fichier JSON de sortie (défaut: stdout)")
+    args = ap.parse_args()
+
+    forced = None
+    if args.label:
+        forced = parse_label(args.label)
+        if forced is None:
+            ap.error("--label doit être 500, 1000, 2000 ou none")
+    thresholds = [float(t) for t in args.thresholds.split(",") if t.strip()]
+
+    report = run(args.inputs, forced, max(1, args.every), args.max_frames, thresholds)
+    if args.no_records:
+        report.pop("records")
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[bench] {report['frames']} frames, {report['fps']} fps -> {args.out}")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
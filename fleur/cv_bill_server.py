@@ -3,10 +3,13 @@
 # POC de reconnaissance de billets (500/1000/2000 DA) par OpenCV.
 # - Multi-templates par valeur (ex: ancienne/nouvelle série).
 # - ORB + Homography (SIFT optionnel si opencv-contrib est installé).
-# - Expose 2 endpoints:
+# - Un seul index FLANN (LSH pour ORB) sur tous les templates: 1 knn par frame;
+#   le candidat le plus voté, s'il reste juste sous MIN_MATCHES, est re-apparié en force brute.
+# - Expose les endpoints:
 #     GET  /healthz          -> "ok"
 #     GET  /cv/scan          -> détecte un billet (sans notifier Django)
 #     POST /cv/stack         -> détecte + notifie Django si confiance OK
+#     GET  /cv/stats         -> latences des appels HTTP vers Django
 #
 # DEPENDANCES:
 #   pip install opencv-python flask flask-cors requests numpy
@@ -21,6 +24,7 @@
 # LANCER:
 #   set CAM_INDEX=0
 #   set CONF_THRESHOLD=0.60
+#   set CV_WORKERS=2          (0 = classification dans le thread Flask)
 #   python cv_bill_server.py
 #
 # INTEGRATION COTE DJANGO:
@@ -29,19 +33,36 @@
 # - La page payment_insert poll ?json=1 (on l’a déjà mis en place).
 # - Bouton "Scanner billet (caméra)" appelle POST /cv/stack {"payment_id": <id>}.
 
+import argparse
+import atexit
+import hashlib
+import json
+import multiprocessing
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import cv2 # type: ignore
 import numpy as np
 import requests
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
+try:
+    from fleur.http_pool import http_client
+except ImportError:  # lancé en script depuis fleur/
+    from http_pool import http_client
+
 # ========= CONFIG =========
 CAM_INDEX       = int(os.getenv("CAM_INDEX", "0"))
 FRAME_WIDTH     = int(os.getenv("FRAME_WIDTH", "1280"))
 FRAME_HEIGHT    = int(os.getenv("FRAME_HEIGHT", "720"))
 FPS             = int(os.getenv("FPS", "30"))
+CAPTURE_THREAD  = os.getenv("CAPTURE_THREAD", "1") == "1"  # lecture caméra en tâche de fond
+CAPTURE_RING    = int(os.getenv("CAPTURE_RING", "8"))      # nb de frames gardés en mémoire
+FRAME_MAX_AGE   = float(os.getenv("FRAME_MAX_AGE", "0.5")) # s, au-delà le frame est périmé
 
 # Métriques OpenCV
 FEATURES        = int(os.getenv("FEATURES", "3000"))
@@ -50,6 +71,34 @@ MIN_MATCHES     = int(os.getenv("MIN_MATCHES", "40"))      # min matches avant h
 RANSAC_REPROJ   = float(os.getenv("RANSAC_REPROJ", "5.0"))
 CONF_THRESHOLD  = float(os.getenv("CONF_THRESHOLD", "0.60"))  # seuil acceptation finale [0..1]
 
+# Index multi-templates (un seul knn par frame sur tous les templates)
+INDEX_KNN       = int(os.getenv("INDEX_KNN", "4"))         # voisins par descripteur du frame
+INDEX_TOP_K     = int(os.getenv("INDEX_TOP_K", "3"))       # templates vérifiés par homographie
+FLANN_CHECKS    = int(os.getenv("FLANN_CHECKS", "50"))
+REMATCH_MIN_VOTES = int(os.getenv("REMATCH_MIN_VOTES", "20"))  # votes à partir desquels un candidat < MIN_MATCHES est re-apparié
+
+# Région du billet (ROI) puis pyramide de secours
+ROI_ENABLED     = os.getenv("ROI", "1") == "1"
+ROI_DETECT_WIDTH= int(os.getenv("ROI_DETECT_WIDTH", "320"))  # largeur de l'image de recherche ROI
+ROI_MIN_AREA    = float(os.getenv("ROI_MIN_AREA", "0.08"))   # fraction min. de l'image couverte
+ROI_MARGIN      = float(os.getenv("ROI_MARGIN", "0.06"))     # marge ajoutée autour du billet
+# frame entier en secours; "0.75,1.0" ajoute un niveau grossier (billet qui
+# remplit le frame) mais double le coût des frames sans billet
+PYRAMID_SCALES  = [float(x) for x in os.getenv("PYRAMID_SCALES", "1.0").split(",") if x.strip()]
+
+# Vote multi-frames pour /cv/stack
+VOTE_K          = int(os.getenv("VOTE_K", "2"))            # frames concordants requis
+VOTE_BUDGET_MS  = int(os.getenv("VOTE_BUDGET_MS", "1500")) # abandon au-delà (ms)
+
+# Filtre "rien n'a bougé" pour /cv/scan
+GATE_ENABLED    = os.getenv("GATE", "1") == "1"
+GATE_DIFF       = float(os.getenv("GATE_DIFF", "6.0"))     # écart moyen (0..255) sous lequel la scène est inchangée
+GATE_MAX_AGE    = float(os.getenv("GATE_MAX_AGE", "10"))   # s, durée de vie du résultat en cache
+EMPTY_EDGE_RATIO= float(os.getenv("EMPTY_EDGE_RATIO", "0.01"))  # densité de contours sous laquelle le slot est vide
+
+# Process de classification (0 = dans le thread de la requête)
+CV_WORKERS      = int(os.getenv("CV_WORKERS", "2"))
+
 # Django API
 DJANGO_API      = os.getenv("DJANGO_API", "http://127.0.0.1:8000/api/payment/insert-event/")
 DJANGO_API_KEY  = os.getenv("DJANGO_API_KEY", "dev-secret")
@@ -64,6 +113,10 @@ TEMPLATES = {
     2000: ["templates/2000_a.jpg", "templates/2000_b.jpg"],
 }
 
+# Cache des features des templates (reconstruit seulement si un template ou
+# les réglages du détecteur changent). Prébuild: python cv_bill_server.py --build-cache
+FEATURE_CACHE   = os.getenv("FEATURE_CACHE", "templates/features_cache.npz")
+
 # ========= INIT OPENCV (ORB par défaut / SIFT optionnel) =========
 USE_SIFT = False
 try:
@@ -74,14 +127,26 @@ try:
 except Exception:
     USE_SIFT = False
 
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH    = 6
+
 if USE_SIFT:
     detector = cv2.SIFT_create(nfeatures=FEATURES)
-    # pour SIFT, on match avec NORM_L2
-    bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
 else:
     detector = cv2.ORB_create(nfeatures=FEATURES)
-    # pour ORB, on match avec NORM_HAMMING
-    bf = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+
+def _index_params():
+    """Index FLANN: KD-tree pour SIFT (float), LSH pour ORB (binaire)."""
+    if USE_SIFT:
+        return dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+    return dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+
+# knnSearch renvoie des distances L2 au carré pour SIFT (Hamming pour ORB)
+RATIO_CMP = RATIO_TEST ** 2 if USE_SIFT else RATIO_TEST
+
+# Recherche exacte (cv2.batchDistance) pour re-vérifier les candidats de l'index
+BF_NORM  = cv2.NORM_L2 if USE_SIFT else cv2.NORM_HAMMING
+BF_DTYPE = cv2.CV_32F if USE_SIFT else cv2.CV_32S
 
 def _load_img(path):
     img = cv2.imread(path, cv2.IMREAD_COLOR)
@@ -96,26 +161,131 @@ def _detect_and_compute(gray):
     kp, des = detector.detectAndCompute(gray, None)
     return kp, des
 
+# ========= CACHE FEATURES TEMPLATES =========
+def _detector_settings():
+    return {"features": FEATURES, "sift": USE_SIFT, "opencv": cv2.__version__}
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _kp_to_arrays(kp):
+    # float: x, y, size, angle, response / int: octave, class_id
+    kpf = np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response) for k in kp], dtype=np.float32).reshape(-1, 5)
+    kpi = np.array([(k.octave, k.class_id) for k in kp], dtype=np.int32).reshape(-1, 2)
+    return kpf, kpi
+
+def load_feature_cache(path=FEATURE_CACHE):
+    """{sha1: (kpf, kpi, des, shape)} si le cache existe et correspond aux réglages actuels."""
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path, allow_pickle=False) as z:
+            meta = json.loads(str(z["meta"]))
+            if meta.get("settings") != _detector_settings():
+                return {}
+            return {
+                sha: (z[f"{sha}_kpf"], z[f"{sha}_kpi"], z[f"{sha}_des"], tuple(int(v) for v in z[f"{sha}_shape"]))
+                for sha in meta.get("templates", [])
+            }
+    except Exception as e:
+        print(f"[cv] cache features ignoré ({path}): {e}")
+        return {}
+
+def save_feature_cache(entries, path=FEATURE_CACHE):
+    """Écriture atomique (fichier temporaire + os.replace): plusieurs workers peuvent démarrer ensemble."""
+    arrays = {"meta": np.array(json.dumps({"settings": _detector_settings(), "templates": sorted(entries)}))}
+    for sha, (kpf, kpi, des, shape) in entries.items():
+        arrays[f"{sha}_kpf"] = kpf
+        arrays[f"{sha}_kpi"] = kpi
+        arrays[f"{sha}_des"] = des
+        arrays[f"{sha}_shape"] = np.array(shape, dtype=np.int32)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+def _template_features(path):
+    img = _load_img(path)
+    g = _gray(img)
+    kp, des = _detect_and_compute(g)
+    kpf, kpi = _kp_to_arrays(kp)
+    if des is None:
+        des = np.empty((0, 128 if USE_SIFT else 32), dtype=np.float32 if USE_SIFT else np.uint8)
+    return kpf, kpi, des, g.shape
+
 class TemplateBank:
-    """Stocke plusieurs templates par montant et leurs features."""
-    def __init__(self, paths_per_amount):
-        self.bank = {}   # amount -> [ {path, gray, kp, des, shape}, ... ]
+    """
+    Stocke plusieurs templates par montant et leurs features.
+    Tous les descripteurs (tous montants confondus) sont empilés dans un seul
+    index FLANN construit au démarrage: un frame = une seule requête knn,
+    quel que soit le nombre de templates.
+    Les features viennent de FEATURE_CACHE (clé = sha1 du fichier + réglages
+    du détecteur); seuls les templates absents ou modifiés sont recalculés.
+    """
+    def __init__(self, paths_per_amount, cache_path=FEATURE_CACHE, rebuild=False):
+        self.bank = {}        # amount -> [ {path, amount, sha1, pts, des, shape}, ... ]
+        self.templates = []   # même dicts, à plat (index = id du template)
+        cached = {} if rebuild else load_feature_cache(cache_path)
+        entries, self.computed = {}, 0
         for amt, paths in paths_per_amount.items():
             items = []
             for p in paths:
-                img = _load_img(p)
-                g = _gray(img)
-                kp, des = _detect_and_compute(g)
+                sha = _file_sha1(p) if os.path.exists(p) else None
+                if sha in cached:
+                    kpf, kpi, des, shape = cached[sha]
+                else:
+                    kpf, kpi, des, shape = _template_features(p)
+                    self.computed += 1
+                entries[sha] = (kpf, kpi, des, shape)
                 items.append({
                     "path": p,
-                    "gray": g,
-                    "kp": kp,
+                    "amount": amt,
+                    "sha1": sha,
+                    "pts": np.ascontiguousarray(kpf[:, :2]),   # (N, 2) float32
                     "des": des,
-                    "shape": g.shape
+                    "shape": shape
                 })
             self.bank[amt] = items
-
-templates_bank = TemplateBank(TEMPLATES)
+            self.templates.extend(items)
+        if cache_path and (self.computed or set(entries) != set(cached)):
+            save_feature_cache(entries, cache_path)
+        self._build_index()
+
+    def _build_index(self):
+        # row_tpl[i]  = id du template propriétaire de la ligne i de l'index
+        # row_kp[i]   = indice du keypoint dans ce template
+        stacked, row_tpl, row_kp = [], [], []
+        for tid, tpl in enumerate(self.templates):
+            des = tpl["des"]
+            if des is None or len(des) == 0:
+                continue
+            stacked.append(des)
+            row_tpl.append(np.full(len(des), tid, dtype=np.int32))
+            row_kp.append(np.arange(len(des), dtype=np.int32))
+        if not stacked:
+            raise RuntimeError("Aucun descripteur dans les templates")
+        self.row_tpl = np.concatenate(row_tpl)
+        self.row_kp = np.concatenate(row_kp)
+        self.row_amount = np.array([self.templates[t]["amount"] for t in self.row_tpl])
+        self.n_rows = len(self.row_tpl)
+        self.index = cv2.flann_Index(np.vstack(stacked), _index_params())
+
+    def knn(self, frame_des):
+        """-> (indices, distances), tableaux (n_frame, k); indice -1 = pas de voisin."""
+        k = min(INDEX_KNN, self.n_rows)
+        return self.index.knnSearch(frame_des, k, params=dict(checks=FLANN_CHECKS))
+
+_templates_bank = None
+def get_templates_bank():
+    """Banque chargée une seule fois par process (serveur ou worker du pool)."""
+    global _templates_bank
+    if _templates_bank is None:
+        _templates_bank = TemplateBank(TEMPLATES)
+    return _templates_bank
 
 # ========= CAMERA =========
 _cam = None
@@ -129,7 +299,95 @@ def get_cam():
         _cam.set(cv2.CAP_PROP_FPS, FPS)
     return _cam
 
+class CaptureWorker(threading.Thread):
+    """
+    Lit la caméra en continu dans un anneau de CAPTURE_RING frames
+    pré-alloués. Les requêtes Flask prennent le dernier frame (ou attendent
+    le suivant) sans attendre l'I/O caméra, et le buffer interne du driver est
+    vidé en permanence (plus de vieux frame servi après une période d'inactivité).
+    """
+    def __init__(self, ring_size=CAPTURE_RING):
+        super().__init__(name="cv-capture", daemon=True)
+        self.ring_size = max(2, ring_size)
+        self._ring = None                      # np.ndarray (N, H, W, 3), alloué au 1er frame
+        self._stamps = [0.0] * self.ring_size  # time.monotonic() de chaque slot
+        self._seq = 0                          # nb de frames publiés depuis le démarrage
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self.last_error = None
+
+    def run(self):
+        cam = get_cam()
+        while not self._stop_event.is_set():
+            slot = self._seq % self.ring_size
+            target = self._ring[slot] if self._ring is not None else None
+            ok, img = cam.read(target) if target is not None else cam.read()
+            if not ok or img is None:
+                self.last_error = "Camera read failed"
+                time.sleep(0.1)
+                continue
+            if self._ring is None or img.shape != self._ring.shape[1:]:
+                # 1er frame (ou changement de résolution): (ré)alloue l'anneau
+                with self._cond:
+                    self._ring = np.empty((self.ring_size,) + img.shape, dtype=img.dtype)
+                    self._seq = 0
+                slot, target = 0, None
+            if img is not target:
+                np.copyto(self._ring[slot], img)
+            # Le slot en cours d'écriture n'est jamais le dernier publié:
+            # on ne publie (seq+1) qu'une fois l'écriture terminée.
+            with self._cond:
+                self._stamps[slot] = time.monotonic()
+                self._seq += 1
+                self.last_error = None
+                self._cond.notify_all()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def _copy_slot(self, seq):
+        return self._ring[(seq - 1) % self.ring_size].copy()
+
+    def latest(self, max_age=FRAME_MAX_AGE, timeout=1.0):
+        """Copie du frame le plus récent (attend un frame frais si besoin)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._seq:
+                    age = time.monotonic() - self._stamps[(self._seq - 1) % self.ring_size]
+                    if age <= max_age:
+                        return self._copy_slot(self._seq)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(self.last_error or "Camera read failed")
+                self._cond.wait(remaining)
+
+    def wait_next(self, after_seq, timeout=1.0):
+        """Attend un frame publié après `after_seq` -> (seq, frame) ou (after_seq, None)."""
+        with self._cond:
+            if self._seq <= after_seq:
+                self._cond.wait_for(lambda: self._seq > after_seq, timeout)
+            if self._seq <= after_seq:
+                return after_seq, None
+            return self._seq, self._copy_slot(self._seq)
+
+_capture = None
+_capture_lock = threading.Lock()
+def get_capture():
+    global _capture
+    with _capture_lock:
+        if _capture is None or not _capture.is_alive():
+            _capture = CaptureWorker()
+            _capture.start()
+        return _capture
+
 def grab_frame():
+    if CAPTURE_THREAD:
+        return get_capture().latest()
     cam = get_cam()
     ok, frame = cam.read()
     if not ok:
@@ -141,57 +399,381 @@ def preprocess(frame_bgr):
     gray = cv2.GaussianBlur(gray, (3,3), 0)
     return gray
 
+def _resize(gray, scale):
+    if abs(scale - 1.0) < 1e-3:
+        return gray
+    h, w = gray.shape[:2]
+    return cv2.resize(gray, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+
+def find_bill_roi(frame_gray, timings=None):
+    """
+    1er étage peu coûteux: contours sur une image réduite (ROI_DETECT_WIDTH px)
+    pour trouver le rectangle du billet. Retourne (x0, y0, x1, y1) en pixels
+    du frame, ou None si rien ne ressemble à un billet.
+    """
+    t0 = time.perf_counter()
+    h, w = frame_gray.shape[:2]
+    scale = min(1.0, ROI_DETECT_WIDTH / float(w))
+    small = _resize(frame_gray, scale)
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, None, iterations=2)
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    roi = None
+    if contours:
+        c = max(contours, key=cv2.contourArea)
+        (_, _), (rw, rh), _ = cv2.minAreaRect(c)
+        area_ratio = (rw * rh) / float(small.shape[0] * small.shape[1])
+        aspect = max(rw, rh) / max(min(rw, rh), 1.0)
+        # billets DA ~2:1 ; on tolère la perspective et un billet en partie hors champ
+        if area_ratio >= ROI_MIN_AREA and 1.2 <= aspect <= 4.0:
+            x, y, bw, bh = cv2.boundingRect(c)
+            mx, my = bw * ROI_MARGIN, bh * ROI_MARGIN
+            roi = (
+                max(0, int((x - mx) / scale)), max(0, int((y - my) / scale)),
+                min(w, int((x + bw + mx) / scale)), min(h, int((y + bh + my) / scale)),
+            )
+    _add_timing(timings, "roi", _ms_since(t0))
+    return roi
+
 # ========= SCORING =========
-def score_against_template(frame_gray, tpl):
-    # tpl: dict(path, gray, kp, des, shape)
-    kp2, des2 = detector.detectAndCompute(frame_gray, None)
-    if des2 is None or tpl["des"] is None or len(tpl["des"]) == 0:
+def _ms_since(t0):
+    return (time.perf_counter() - t0) * 1000.0
+
+def _add_timing(timings, stage, ms):
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + ms
+
+def extract_frame_features(frame_gray, timings=None):
+    """Positions (N, 2) et descripteurs du frame, calculés UNE seule fois par scan."""
+    t0 = time.perf_counter()
+    kp, des = _detect_and_compute(frame_gray)
+    pts = cv2.KeyPoint_convert(kp) if kp else np.empty((0, 2), dtype=np.float32)
+    _add_timing(timings, "detect", _ms_since(t0))
+    return pts, des
+
+def vote_matches(frame_des, timings=None):
+    """
+    Une requête knn sur l'index -> {template_id: (frame_idx, tpl_kp_idx, dist)},
+    trois tableaux NumPy par template (aucun objet DMatch).
+    Ratio test de Lowe: le 2e voisin retenu est le premier qui appartient au
+    même template OU à un autre montant (les variantes a/b d'un même billet
+    se ressemblent et ne doivent pas s'annuler entre elles).
+    """
+    votes = {}
+    if frame_des is None or len(frame_des) < 2:
+        return votes
+
+    t0 = time.perf_counter()
+    bank = get_templates_bank()
+    idx, dist = bank.knn(frame_des)
+    valid = idx >= 0
+    safe = np.where(valid, idx, 0)
+    tpl = np.where(valid, bank.row_tpl[safe], -1)
+    amt = np.where(valid, bank.row_amount[safe], -1)
+
+    # 1er voisin "concurrent" parmi les voisins 2..k
+    rival = valid[:, 1:] & ((tpl[:, 1:] == tpl[:, :1]) | (amt[:, 1:] != amt[:, :1]))
+    has_rival = rival.any(axis=1)
+    d_rival = dist[:, 1:][np.arange(len(idx)), rival.argmax(axis=1)] if rival.shape[1] else dist[:, 0]
+    keep = valid[:, 0] & (~has_rival | (dist[:, 0] < RATIO_CMP * d_rival))
+
+    frame_idx = np.flatnonzero(keep)
+    tids = tpl[keep, 0]
+    kp_idx = bank.row_kp[idx[keep, 0]]
+    d0 = dist[keep, 0]
+    order = np.argsort(tids, kind="stable")
+    uniq, starts = np.unique(tids[order], return_index=True)
+    for tid, chunk in zip(uniq.tolist(), np.split(order, starts[1:])):
+        votes[tid] = (frame_idx[chunk], kp_idx[chunk], d0[chunk])
+    _add_timing(timings, "match", _ms_since(t0))
+    return votes
+
+def rematch_template(frame_des, tpl, timings=None):
+    """
+    Appariement exact template -> frame (2 plus proches voisins + ratio test),
+    dans le même sens que l'ancien matcher par template, puis vérification
+    croisée (le plus proche voisin du point du frame dans le template doit
+    être le même point). L'index (frame -> tous les templates) trouve moins
+    de paires quand le billet est petit dans le frame: un bon candidat peut
+    rester juste sous MIN_MATCHES. cv2.batchDistance renvoie directement des
+    tableaux (distances, indices): aucun objet DMatch. Même format de sortie
+    que vote_matches: (frame_idx, tpl_kp_idx, dist).
+    """
+    empty = np.empty(0, dtype=np.int32)
+    if frame_des is None or len(frame_des) < 2:
+        return empty, empty, np.empty(0, dtype=np.float32)
+    t0 = time.perf_counter()
+    dist, nn = cv2.batchDistance(tpl["des"], frame_des, BF_DTYPE, normType=BF_NORM, K=2)
+    kp_idx = np.flatnonzero(dist[:, 0] < RATIO_TEST * dist[:, 1]).astype(np.int32)
+    frame_idx = nn[kp_idx, 0]
+    if len(kp_idx):
+        # vérification croisée sur les seuls points du frame retenus
+        _, back = cv2.batchDistance(frame_des[frame_idx], tpl["des"], BF_DTYPE, normType=BF_NORM, K=1)
+        keep = back[:, 0] == kp_idx
+        kp_idx, frame_idx = kp_idx[keep], frame_idx[keep]
+    _add_timing(timings, "rematch", _ms_since(t0))
+    return frame_idx, kp_idx, dist[kp_idx, 0].astype(np.float32)
+
+def score_against_template(frame_pts, tpl, good, timings=None):
+    """
+    tpl: dict(path, amount, sha1, pts, des, shape)
+    good: (frame_idx, tpl_kp_idx, dist) issus de vote_matches
+    Retourne (score, H) ; (0.0, None) si pas assez de paires.
+    """
+    frame_idx, kp_idx, _ = good
+    n_good = len(frame_idx)
+    if n_good < MIN_MATCHES:
         return 0.0, None
 
-    matches = bf.knnMatch(tpl["des"], des2, k=2)
-    good = []
-    for m, n in matches:
-        if m.distance < RATIO_TEST * n.distance:
-            good.append(m)
-
-    if len(good) < MIN_MATCHES:
+    t0 = time.perf_counter()
+    # une homographie demande au moins 4 points distincts du template
+    if len(np.unique(kp_idx)) < 4:
         return 0.0, None
 
-    src_pts = np.float32([tpl["kp"][m.queryIdx].pt for m in good]).reshape(-1,1,2)
-    dst_pts = np.float32([kp2[m.trainIdx].pt for m in good]).reshape(-1,1,2)
+    src_pts = tpl["pts"][kp_idx].reshape(-1,1,2)
+    dst_pts = frame_pts[frame_idx].reshape(-1,1,2)
 
     H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, RANSAC_REPROJ)
+    _add_timing(timings, "homography", _ms_since(t0))
     if H is None or mask is None:
         return 0.0, None
 
     inliers = int(mask.sum())
-    score = inliers / max(len(good), 1)
+    score = inliers / n_good
     return float(score), H
 
-def classify_bill(frame_bgr):
+def classify_gray(gray, timings=None):
+    """
+    Features + vote + homographie sur une image déjà prétraitée.
+    Retourne (best_amount, best_score, best_template_path, n_pairs), n_pairs
+    = plus grand nombre de paires d'un candidat (>= MIN_MATCHES: l'échelle
+    suffit pour trancher, même si le score reste sous le seuil).
+    """
+    frame_pts, frame_des = extract_frame_features(gray, timings)
+    votes = vote_matches(frame_des, timings)
+
+    candidates = sorted(votes.items(), key=lambda kv: len(kv[1][0]), reverse=True)[:INDEX_TOP_K]
+
+    best_amt, best_score, best_tpl_path, n_pairs = None, 0.0, None, 0
+    for rank, (tid, good) in enumerate(candidates):
+        tpl = get_templates_bank().templates[tid]
+        # un seul re-appariement (~150 ms): le candidat le plus voté
+        if rank == 0 and REMATCH_MIN_VOTES <= len(good[0]) < MIN_MATCHES:
+            good = rematch_template(frame_des, tpl, timings)
+        n_pairs = max(n_pairs, len(good[0]))
+        s, _ = score_against_template(frame_pts, tpl, good, timings)
+        if s > best_score:
+            best_score, best_amt, best_tpl_path = s, tpl["amount"], tpl["path"]
+    return best_amt, best_score, best_tpl_path, n_pairs
+
+def classify_bill(frame_bgr, timings=None):
     """
     Retourne (best_amount, best_score, best_template_path)
     Score d'un montant = max(score de ses templates).
+    Seuls les INDEX_TOP_K templates les plus votés passent à l'homographie.
+    1) ROI du billet (find_bill_roi) -> features uniquement dans la ROI, à la
+       résolution native (réduire la ROI fait chuter le nombre de paires)
+    2) si pas de ROI ou score < CONF_THRESHOLD: frame entier, du plus petit
+       au plus grand facteur de PYRAMID_SCALES, arrêt dès qu'une échelle
+       atteint le seuil ou donne MIN_MATCHES paires pour un candidat.
+    Si `timings` (dict) est fourni, il reçoit la durée en ms de chaque étape
+    (preprocess, roi, detect, match, rematch, homography, total).
     """
+    t_start = time.perf_counter()
     frame_gray = preprocess(frame_bgr)
-
-    best_amt, best_score, best_tpl_path = None, 0.0, None
-    for amt, tpl_list in templates_bank.bank.items():
-        local_best = 0.0
-        local_path = None
-        for tpl in tpl_list:
-            s, _ = score_against_template(frame_gray, tpl)
-            if s > local_best:
-                local_best = s
-                local_path = tpl["path"]
-        if local_best > best_score:
-            best_score, best_amt, best_tpl_path = local_best, amt, local_path
-
-    return best_amt, best_score, best_tpl_path
+    _add_timing(timings, "preprocess", _ms_since(t_start))
+
+    best = (None, 0.0, None)
+    roi = find_bill_roi(frame_gray, timings) if ROI_ENABLED else None
+    if roi is not None:
+        x0, y0, x1, y1 = roi
+        best = classify_gray(frame_gray[y0:y1, x0:x1], timings)[:3]
+
+    if best[1] < CONF_THRESHOLD:
+        for scale in sorted(PYRAMID_SCALES):
+            *res, n_pairs = classify_gray(_resize(frame_gray, scale), timings)
+            if res[1] > best[1]:
+                best = tuple(res)
+            if best[1] >= CONF_THRESHOLD or n_pairs >= MIN_MATCHES:
+                break
+
+    _add_timing(timings, "total", _ms_since(t_start))
+    return best
+
+def classify_stream(k=VOTE_K, budget_ms=VOTE_BUDGET_MS, timings=None):
+    """
+    Vote temporel: classe les frames au fil de l'eau et s'arrête dès que k
+    frames donnent le même montant avec score >= CONF_THRESHOLD, ou quand le
+    budget (ms) est épuisé.
+    Retourne (amount|None, best_score, best_template_path, tally, frames_used)
+    où tally = {amount: nb de frames concordants}.
+    """
+    deadline = time.monotonic() + budget_ms / 1000.0
+    tally, best = {}, {}   # best: amount -> (score, template)
+    frames_used = 0
+    seq = None
+    while True:
+        if CAPTURE_THREAD:
+            worker = get_capture()
+            if seq is None:
+                frame, seq = worker.latest(), worker.seq
+            else:
+                seq, frame = worker.wait_next(seq, timeout=max(0.0, deadline - time.monotonic()))
+        else:
+            frame = grab_frame()
+
+        if frame is not None:
+            frames_used += 1
+            amt, score, tpl = run_classify(frame, timings)
+            if amt in ALLOWED_AMOUNTS and score >= CONF_THRESHOLD:
+                tally[amt] = tally.get(amt, 0) + 1
+                if score > best.get(amt, (0.0, None))[0]:
+                    best[amt] = (score, tpl)
+                if tally[amt] >= k:
+                    return amt, best[amt][0], best[amt][1], tally, frames_used
+
+        if time.monotonic() >= deadline:
+            break
+
+    # Budget épuisé: on rapporte le montant le plus voté, sans le valider
+    if tally:
+        amt = max(tally, key=lambda a: (tally[a], best[a][0]))
+        return None, best[amt][0], best[amt][1], tally, frames_used
+    return None, 0.0, None, tally, frames_used
+
+# ========= WORKERS (process pool) =========
+# Chaque worker possède son détecteur ORB/SIFT et sa TemplateBank (chargée une
+# fois dans l'initializer). Le frame passe par un bloc de mémoire partagée: seuls
+# (nom du bloc, shape, dtype) sont picklés, pas les ~2.7 Mo de pixels.
+_worker_shm = {}   # côté worker: nom -> SharedMemory déjà attaché
+
+def _worker_init():
+    get_templates_bank()
+
+def _worker_classify(shm_name, shape, dtype):
+    shm = _worker_shm.get(shm_name)
+    if shm is None:
+        shm = _worker_shm[shm_name] = shared_memory.SharedMemory(name=shm_name)
+    frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    timings = {}
+    amt, score, tpl = classify_bill(frame, timings)
+    return amt, score, tpl, timings
+
+class FrameSlots:
+    """Blocs de mémoire partagée réutilisables (un par classification en vol)."""
+    def __init__(self, count, nbytes):
+        self.nbytes = nbytes
+        self._all = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(count)]
+        self._free = queue.Queue()
+        for shm in self._all:
+            self._free.put(shm)
+
+    def acquire(self, nbytes, timeout=5.0):
+        if nbytes > self.nbytes:
+            raise ValueError(f"frame trop grand pour la mémoire partagée ({nbytes} > {self.nbytes} octets)")
+        return self._free.get(timeout=timeout)
+
+    def release(self, shm):
+        self._free.put(shm)
+
+    def close(self):
+        for shm in self._all:
+            shm.close()
+            shm.unlink()
+
+_pool = None
+_slots = None
+_pool_lock = threading.Lock()
+_classify_lock = threading.Lock()   # détecteur/index partagés quand CV_WORKERS=0
+
+def get_pool():
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is None:
+            # marge si le driver ignore FRAME_WIDTH/FRAME_HEIGHT et renvoie du 1080p
+            _slots = FrameSlots(CV_WORKERS * 2, max(FRAME_WIDTH * FRAME_HEIGHT, 1920 * 1080) * 3)
+            # spawn: un fork hériterait de l'état du thread de capture
+            # (verrous, VideoCapture) et peut bloquer le worker
+            _pool = ProcessPoolExecutor(max_workers=CV_WORKERS, initializer=_worker_init,
+                                        mp_context=multiprocessing.get_context("spawn"))
+            atexit.register(_shutdown_pool)
+        return _pool
+
+def _shutdown_pool():
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+    if _slots is not None:
+        _slots.close()
+
+def classify_async(frame_bgr):
+    """Soumet le frame au pool -> Future de (amount, score, template, timings)."""
+    pool = get_pool()
+    frame_bgr = np.ascontiguousarray(frame_bgr)
+    shm = _slots.acquire(frame_bgr.nbytes)
+    try:
+        np.ndarray(frame_bgr.shape, dtype=frame_bgr.dtype, buffer=shm.buf)[...] = frame_bgr
+        fut = pool.submit(_worker_classify, shm.name, frame_bgr.shape, frame_bgr.dtype.str)
+    except Exception:
+        _slots.release(shm)
+        raise
+    fut.add_done_callback(lambda _f: _slots.release(shm))
+    return fut
+
+def run_classify(frame_bgr, timings=None):
+    """classify_bill via le pool (ou en local si CV_WORKERS=0), bloquant pour l'appelant."""
+    if CV_WORKERS <= 0 or frame_bgr.nbytes > max(FRAME_WIDTH * FRAME_HEIGHT, 1920 * 1080) * 3:
+        with _classify_lock:
+            return classify_bill(frame_bgr, timings)
+    t0 = time.perf_counter()
+    amt, score, tpl, worker_timings = classify_async(frame_bgr).result()
+    if timings is not None:
+        for stage, ms in worker_timings.items():
+            _add_timing(timings, stage, ms)
+        # transfert + attente d'un worker libre
+        _add_timing(timings, "pool", max(0.0, _ms_since(t0) - worker_timings.get("total", 0.0)))
+    return amt, score, tpl
+
+def _round_timings(timings):
+    return {k: round(v, 1) for k, v in timings.items()}
+
+# ========= FILTRE CHANGEMENT DE SCENE =========
+class FrameGate:
+    """
+    Compare une vignette 64x36 du frame à celle du dernier frame classé:
+    si rien n'a bougé, /cv/scan renvoie le résultat précédent sans relancer
+    le classifieur; si la scène n'a quasiment aucun contour, le slot est vide.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thumb = None
+        self._result = None
+        self._stamp = 0.0
+
+    @staticmethod
+    def summarize(frame_bgr):
+        """-> (vignette float32 64x36, densité de contours sur une image 160 px)."""
+        small = cv2.resize(_gray(frame_bgr), (160, 90), interpolation=cv2.INTER_AREA)
+        edges = cv2.Canny(small, 50, 150)
+        thumb = cv2.resize(small, (64, 36), interpolation=cv2.INTER_AREA).astype(np.float32)
+        return thumb, float(np.count_nonzero(edges)) / edges.size
+
+    def lookup(self, thumb):
+        with self._lock:
+            if self._thumb is None or time.monotonic() - self._stamp > GATE_MAX_AGE:
+                return None
+            if float(np.mean(np.abs(thumb - self._thumb))) > GATE_DIFF:
+                return None
+            return self._result
+
+    def store(self, thumb, result):
+        with self._lock:
+            self._thumb, self._result, self._stamp = thumb, result, time.monotonic()
+
+frame_gate = FrameGate()
 
 # ========= DJANGO NOTIFY =========
 def notify_django(payment_id, amount):
-    r = requests.post(
+    r = http_client.post(
         DJANGO_API,
         json={"payment_id": int(payment_id), "amount": int(amount), "event": "bill_cv"},
         headers={"X-Api-Key": DJANGO_API_KEY},
@@ -208,23 +790,51 @@ CORS(app)
 def healthz():
     return "ok", 200
 
+@app.get("/cv/stats")
+def cv_stats():
+    """Latences des appels à Django (pool HTTP keep-alive)."""
+    return jsonify({"ok": True, "http": http_client.stats()})
+
 @app.get("/cv/scan")
 def cv_scan_get():
     """
     Capture l’image courante, classe le billet et renvoie {amount, confidence, template}.
     N’envoie rien à Django.
+    Si la scène n'a pas changé depuis le dernier scan -> résultat en cache ("cached": true);
+    slot vide -> réponse immédiate ("empty": true), sans classification.
     """
     frame = grab_frame()
-    amt, score, tpl = classify_bill(frame)
+    timings = {}
+    thumb = None
+    if GATE_ENABLED:
+        t0 = time.perf_counter()
+        thumb, edge_ratio = FrameGate.summarize(frame)
+        cached = frame_gate.lookup(thumb)
+        _add_timing(timings, "gate", _ms_since(t0))
+        if cached is not None:
+            return jsonify({**cached, "cached": True, "timings_ms": _round_timings(timings)})
+        if edge_ratio < EMPTY_EDGE_RATIO:
+            result = {"ok": False, "amount": None, "confidence": 0.0, "template": None, "empty": True}
+            frame_gate.store(thumb, result)
+            return jsonify({**result, "cached": False, "timings_ms": _round_timings(timings)})
+
+    amt, score, tpl = run_classify(frame, timings)
     if not amt:
-        return jsonify({"ok": False, "amount": None, "confidence": 0.0, "template": None})
-    return jsonify({"ok": True, "amount": int(amt), "confidence": float(score), "template": tpl})
+        result = {"ok": False, "amount": None, "confidence": 0.0, "template": None}
+    else:
+        result = {"ok": True, "amount": int(amt), "confidence": float(score), "template": tpl}
+    if thumb is not None:
+        frame_gate.store(thumb, result)
+    return jsonify({**result, "cached": False, "timings_ms": _round_timings(timings)})
 
 @app.post("/cv/stack")
 def cv_stack_post():
     """
-    Body JSON: { "payment_id": 42 }
+    Body JSON: { "payment_id": 42, "mode": "vote"|"single", "votes": 2, "budget_ms": 1500 }
     1) Capture -> classification
+       - mode "vote" (défaut si VOTE_K > 1): frames successifs jusqu'à `votes`
+         frames concordants ou `budget_ms` écoulés (cf. classify_stream)
+       - mode "single": un seul frame
     2) Si confidence >= CONF_THRESHOLD et amount ∈ ALLOWED_AMOUNTS -> notifie Django
     """
     data = request.get_json(silent=True) or {}
@@ -232,8 +842,21 @@ def cv_stack_post():
     if not isinstance(payment_id, int):
         return jsonify({"ok": False, "error": "payment_id (int) required"}), 400
 
-    frame = grab_frame()
-    amt, score, tpl = classify_bill(frame)
+    mode = data.get("mode") or ("vote" if VOTE_K > 1 else "single")
+    timings = {}
+    extra = {}
+    if mode == "vote":
+        try:
+            k = max(1, int(data.get("votes", VOTE_K)))
+            budget_ms = max(0, int(data.get("budget_ms", VOTE_BUDGET_MS)))
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": "votes/budget_ms must be int"}), 400
+        amt, score, tpl, tally, frames_used = classify_stream(k, budget_ms, timings)
+        extra = {"mode": "vote", "votes": {str(a): n for a, n in tally.items()}, "frames": frames_used}
+    else:
+        frame = grab_frame()
+        amt, score, tpl = run_classify(frame, timings)
+        extra = {"mode": "single", "frames": 1}
 
     if amt in ALLOWED_AMOUNTS and score >= CONF_THRESHOLD:
         try:
@@ -243,6 +866,8 @@ def cv_stack_post():
                 "amount": int(amt),
                 "confidence": float(score),
                 "template": tpl,
+                "timings_ms": _round_timings(timings),
+                **extra,
                 "forwarded": dj
             })
         except requests.RequestException as e:
@@ -252,11 +877,30 @@ def cv_stack_post():
             "ok": False,
             "amount": int(amt) if amt else None,
             "confidence": float(score),
-            "template": tpl
+            "template": tpl,
+            "timings_ms": _round_timings(timings),
+            **extra
         }), 422
 
 if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--build-cache", action="store_true",
+                    help=f"(re)calcule {FEATURE_CACHE} puis quitte (à lancer au déploiement)")
+    args = ap.parse_args()
+    if args.build_cache:
+        bank = TemplateBank(TEMPLATES, rebuild=True)
+        print(f"[cv] {FEATURE_CACHE}: {len(bank.templates)} templates, settings={_detector_settings()}")
+        raise SystemExit(0)
+
     host = os.getenv("CV_HOST", "127.0.0.1")
     port = int(os.getenv("CV_PORT", "9998"))
     print(f"[cv] Serving on http://{host}:{port} (SIFT={int(USE_SIFT)}, THRESH={CONF_THRESHOLD})")
-    app.run(host=host, port=port, debug=False)
+    # cache à jour avant de lancer les workers (ils le lisent tous au démarrage)
+    get_templates_bank()
+    if CV_WORKERS > 0:
+        # démarre les workers (et leur TemplateBank) avant le 1er scan
+        for _ in range(CV_WORKERS):
+            get_pool().submit(_worker_init)
+    if CAPTURE_THREAD:
+        get_capture()  # démarre la capture tout de suite (caméra chaude au 1er scan)
+    app.run(host=host, port=port, debug=False, threaded=True)
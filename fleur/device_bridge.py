@@ -1,12 +1,34 @@
 # device_bridge.py RS32
-import code
-import serial, time, requests, argparse
+# Standalone bridge: reads the bill acceptor on a serial port and credits
+# each accepted bill on one payment.
+#   python device_bridge.py --com COM3 --payment 42                   # 1 octet = 1 code billet
+#   python device_bridge.py --com COM3 --payment 42 --protocol id003  # validateur JCM ID-003
+#
+# The serial reader never sleeps: it blocks in read() (with timeout) for
+# whatever is available and hands each decoded bill to a sender thread
+# through a bounded queue, so a slow Django never delays the next read.
+# Every bill is logged with read / queued / posted timestamps.
+import argparse
+import queue
+import threading
+import time
+import uuid
 
-from fleur.device_bridge_server import post_to_django # type: ignore
+import requests
+import serial
+
+try:
+    from fleur.http_pool import http_client, is_retryable
+    from fleur import id003
+except ImportError:  # run as a script from fleur/
+    from http_pool import http_client, is_retryable
+    import id003
 
 # CONFIG
 API_URL = "http://127.0.0.1:8000/api/payment/insert-event/"
 API_KEY = "dev-secret"
+SEND_QUEUE_SIZE = 64
+RETRY_MAX_S = 30
 
 # mapping code reçu -> montant en DA
 DENOM_MAP = {
@@ -14,40 +36,132 @@ DENOM_MAP = {
     0x02: 1000,
     0x03: 2000,
 }
-# si escrow -> stack, puis quand device confirme "stacked" avec code 0x02 :
-amount = DENOM_MAP.get(code)
-if amount in (500, 1000, 2000):
-    post_to_django(payment_id, amount) # type: ignore
-    
-def post_amount(payment_id, amount):
-    requests.post(API_URL, json={
+# ID-003: code ESCROW -> montant en DA (à ajuster selon la table du validateur)
+ID003_DENOM_MAP = {
+    0x61: 500,
+    0x62: 1000,
+    0x63: 2000,
+}
+
+
+def log(msg):
+    now = time.time()
+    print(f"[bridge] {time.strftime('%H:%M:%S', time.localtime(now))}.{int(now * 1000) % 1000:03d} {msg}",
+          flush=True)
+
+
+def post_amount(payment_id, amount, event_id=None):
+    body = {
         "payment_id": payment_id,
         "amount": amount,
         "event": "bill_inserted",
-    }, headers={"X-Api-Key": API_KEY}, timeout=2)
+    }
+    if event_id:
+        body["event_id"] = event_id
+    r = http_client.post(API_URL, json=body, headers={"X-Api-Key": API_KEY}, timeout=2)
+    r.raise_for_status()
+    return r.json()
+
+
+def sender(events: queue.Queue, payment_id: int):
+    """Posts queued bills in order; network and transient HTTP errors are retried with the same event_id."""
+    while True:
+        ev = events.get()
+        ev["t_dequeued"] = time.time()
+        delay = 0.5
+        while True:
+            try:
+                post_amount(payment_id, ev["amount"], ev["event_id"])
+                break
+            except requests.HTTPError as e:
+                if not is_retryable(e):
+                    log(f"post rejected ({ev['event_id']}): {e}")
+                    break
+                err = e
+            except requests.RequestException as e:
+                err = e
+            log(f"post failed, retry in {delay:.1f}s: {err}")
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_S)
+        t_done = time.time()
+        log(f"+{ev['amount']} DA posted  read->queued {(ev['t_queued'] - ev['t_read']) * 1000:.1f} ms"
+            f"  queue {(ev['t_dequeued'] - ev['t_queued']) * 1000:.1f} ms"
+            f"  post {(t_done - ev['t_dequeued']) * 1000:.1f} ms"
+            f"  total {(t_done - ev['t_read']) * 1000:.1f} ms")
+        events.task_done()
+
+
+def emit(events: queue.Queue, amount: int, t_read: float, code: int):
+    ev = {"amount": amount, "code": code, "event_id": uuid.uuid4().hex,
+          "t_read": t_read, "t_queued": time.time()}
+    if events.full():
+        log(f"send queue full ({events.maxsize}), reader waits for Django")
+    events.put(ev)
+    log(f"bill code 0x{code:02X} -> {amount} DA queued")
+
+
+def read_bytes(ser, events: queue.Queue):
+    """Protocole simple: chaque octet reçu code une dénomination."""
+    while True:
+        # blocks until at least one byte (or timeout), then takes everything already buffered
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            continue
+        t_read = time.time()
+        for b in data:          # iterating bytes yields ints, the DENOM_MAP keys
+            amount = DENOM_MAP.get(b)
+            if amount:
+                emit(events, amount, t_read, b)
+            else:
+                log(f"unknown code 0x{b:02X} ignored")
+
+
+def read_id003(ser, events: queue.Queue, poll_interval: float):
+    """ID-003: stacks every allowed bill in escrow, credits it on VEND_VALID."""
+    dev = id003.Id003Device(ser, poll_interval=poll_interval).start()
+    sub = dev.subscribe()
+    dev.enable(ID003_DENOM_MAP)
+    escrow_code = None
+    while True:
+        ev = sub.get()
+        if ev.name == "ESCROW":
+            escrow_code = ev.data[0] if ev.data else None
+            if escrow_code in ID003_DENOM_MAP:
+                dev.send(id003.CMD_STACK_1)
+            else:
+                dev.send(id003.CMD_RETURN)
+                log(f"escrow code 0x{escrow_code or 0:02X} not allowed, returned")
+        elif ev.name == "VEND_VALID" and escrow_code in ID003_DENOM_MAP:
+            emit(events, ID003_DENOM_MAP[escrow_code], ev.ts, escrow_code)
+            escrow_code = None
+        elif ev.name in id003.ERROR_STATES or ev.name == "REJECTING":
+            log(f"acceptor {ev.name} {ev.data.hex()}")
+
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--com", default="COM3")
     ap.add_argument("--baud", type=int, default=9600)
     ap.add_argument("--payment", type=int, required=True, help="Payment ID en cours")
+    ap.add_argument("--protocol", choices=("byte", "id003"), default="byte",
+                    help="byte: 1 octet = 1 code billet; id003: validateur JCM ID-003")
+    ap.add_argument("--poll-ms", type=int, default=100, help="période de poll ID-003")
     args = ap.parse_args()
 
-    with serial.Serial(args.com, args.baud, timeout=0.1) as ser:
-        print(f"[bridge] listening on {args.com} @ {args.baud}, payment={args.payment}")
-        while True:
-            b = ser.read(1)
-            if not b:
-                time.sleep(0.01)
-                continue
-            # Ex: chaque octet code une dénomination
-            amount = DENOM_MAP.get(b)
-            if amount:
-                print(f"[bridge] +{amount} DA")
-                try:
-                    post_amount(args.payment, amount)
-                except Exception as e:
-                    print("[bridge] post failed:", e)
+    events = queue.Queue(maxsize=SEND_QUEUE_SIZE)
+    threading.Thread(target=sender, args=(events, args.payment), name="sender", daemon=True).start()
+
+    parity = serial.PARITY_EVEN if args.protocol == "id003" else serial.PARITY_NONE
+    with serial.Serial(args.com, args.baud, parity=parity, timeout=0.05) as ser:
+        log(f"listening on {args.com} @ {args.baud} ({args.protocol}), payment={args.payment}")
+        try:
+            if args.protocol == "id003":
+                read_id003(ser, events, args.poll_ms / 1000.0)
+            else:
+                read_bytes(ser, events)
+        except KeyboardInterrupt:
+            log(f"stopping, {events.qsize()} bill(s) still queued")
+            events.join()
 
 if __name__ == "__main__":
     main()
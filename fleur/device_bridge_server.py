@@ -1,21 +1,45 @@
 # device_bridge_server.py
 # Run:  pip install flask flask-cors requests pyserial
 #       python device_bridge_server.py
+#       python device_bridge_server.py --requeue-dead   # retry parked outbox events, then exit
 #
 # ENV (optional):
 #   BRIDGE_HOST=127.0.0.1
 #   BRIDGE_PORT=9999
 #   DJANGO_API=http://127.0.0.1:8000/api/payment/insert-event/
+#   DJANGO_BATCH_API=http://127.0.0.1:8000/api/payment/insert-events/
 #   DJANGO_API_KEY=dev-secret
 #   SIMULATE=1            # 1=simulate accept immediately, 0=use serial
 #   SERIAL_PORT=COM3
 #   SERIAL_BAUD=9600
+#   ACCEPT_TIMEOUT=10     # seconds a /stack call waits for the bill (serial mode)
+#   ID003_POLL_MS=100     # acceptor status poll period
+#   OUTBOX_PATH=bridge_outbox.sqlite3   # durable queue of accepted bills
+#   OUTBOX_BATCH=20
+#   OUTBOX_BACKOFF_MAX=60               # seconds, cap of the retry backoff
+#   RELAY_SERIAL_PORT=COM4
+#   RELAY_PULSE_MS=700                  # relay ON time per open
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import requests
+import argparse
+import heapq
 import os
+import queue
+import random
+import sqlite3
+import threading
 import time
+import uuid
+from collections import OrderedDict, deque
+
+try:
+    from fleur.http_pool import http_client, is_retryable
+    from fleur.id003 import CMD_RETURN, CMD_STACK_1, ERROR_STATES, Id003Device
+except ImportError:  # run as a script from fleur/
+    from http_pool import http_client, is_retryable
+    from id003 import CMD_RETURN, CMD_STACK_1, ERROR_STATES, Id003Device
 
 # Optional serial (only used if SIMULATE=0)
 try:
@@ -30,10 +54,14 @@ CORS(app)
 BRIDGE_HOST   = os.getenv("BRIDGE_HOST", "127.0.0.1")
 BRIDGE_PORT   = int(os.getenv("BRIDGE_PORT", "9999"))
 DJANGO_API    = os.getenv("DJANGO_API", "http://127.0.0.1:8000/api/payment/insert-event/")
+DJANGO_BATCH_API = os.getenv("DJANGO_BATCH_API", DJANGO_API.rstrip("/").rsplit("/", 1)[0] + "/insert-events/")
 DJANGO_API_KEY= os.getenv("DJANGO_API_KEY", "dev-secret")
 SIMULATE      = os.getenv("SIMULATE", "1") == "1"  # True by default
 SERIAL_PORT   = os.getenv("SERIAL_PORT", "COM3")
 SERIAL_BAUD   = int(os.getenv("SERIAL_BAUD", "9600"))
+OUTBOX_PATH   = os.getenv("OUTBOX_PATH", "bridge_outbox.sqlite3")
+OUTBOX_BATCH  = int(os.getenv("OUTBOX_BATCH", "20"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "60"))
 
 # Allowed bills in DA
 ALLOWED_BILLS = {500, 1000, 2000}
@@ -50,52 +78,224 @@ def open_serial():
         return _ser
     if serial is None:
         raise RuntimeError("pyserial not installed; pip install pyserial (or set SIMULATE=1).")
-    _ser = serial.Serial(SERIAL_PORT, SERIAL_BAUD, timeout=0.25)
+    # ID-003: 8E1; short timeout so the reader thread keeps its poll cadence
+    _ser = serial.Serial(SERIAL_PORT, SERIAL_BAUD, parity=serial.PARITY_EVEN, timeout=0.05)
     return _ser
 
-def post_to_django(payment_id: int, amount: int):
-    """Notify Django that a bill was accepted."""
-    r = requests.post(
+def post_to_django(payment_id: int, amount: int, event: str = "bill_inserted", event_id: str = None):
+    """Notify Django that a bill was accepted. `event_id` is the idempotency key."""
+    body = {"payment_id": payment_id, "amount": amount, "event": event}
+    if event_id:
+        body["event_id"] = event_id
+    r = http_client.post(
         DJANGO_API,
-        json={"payment_id": payment_id, "amount": amount, "event": "bill_inserted"},
+        json=body,
         headers={"X-Api-Key": DJANGO_API_KEY},
         timeout=3,
     )
     r.raise_for_status()
     return r.json()
 
-def accept_bill_via_serial(amount: int) -> bool:
+def post_batch_to_django(events: list):
+    """Send several outbox events in one round-trip; returns Django's per-event results (same order)."""
+    r = http_client.post(
+        DJANGO_BATCH_API,
+        json={"events": events},
+        headers={"X-Api-Key": DJANGO_API_KEY},
+        timeout=5,
+    )
+    r.raise_for_status()
+    return r.json()["results"]
+
+class Outbox:
     """
-    Placeholder for your TB74/TH50N serial logic:
-    - Send commands to enable acceptor / stack escrow
-    - Wait for device response that confirms the denomination
-    - Return True only if the device confirms acceptance of *this* amount
+    Durable queue of bill events (SQLite in WAL mode).
+    /stack commits the event here *before* answering, then a background
+    sender drains it to Django with retries and exponential backoff. The
+    event_id travels with every attempt so Django can drop duplicates.
+    A slow or restarting Django therefore never loses an accepted bill.
     """
-    ser = open_serial()
-    # >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-    # TODO: Replace with your actual protocol.
-    # Example pseudo-flow:
-    #
-    # 1) Enable acceptor / set inhibit mask to allow 500/1000/2000
-    #    ser.write(b'\xAA\x...')  # bytes per your device doc
-    #
-    # 2) Prompt stack escrow or wait for note detection
-    #    start = time.time()
-    #    denom_code = None
-    #    while time.time() - start < 5:
-    #        data = ser.read(64)          # read any available bytes
-    #        # parse data to detect accepted denomination -> set denom_code
-    #        if denom_code_detected:
-    #            break
-    #
-    # 3) Map parsed denom_code to amount and compare with requested 'amount'
-    #    if mapped_amount == amount:
-    #        return True
-    #
-    # For now, simulate a tiny delay so UI feels real:
-    time.sleep(0.8)
-    # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
-    return True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            event_id        TEXT NOT NULL UNIQUE,
+            payment_id      INTEGER NOT NULL,
+            amount          INTEGER NOT NULL,
+            event           TEXT NOT NULL,
+            created_at      REAL NOT NULL,
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL DEFAULT 0,
+            sent_at         REAL,
+            dead            INTEGER NOT NULL DEFAULT 0,
+            last_error      TEXT
+        );
+        CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (sent_at, dead, next_attempt_at);
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sender = None
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")  # money: fsync every commit
+        self._db.executescript(self.SCHEMA)
+
+    def enqueue(self, payment_id: int, amount: int, event: str = "bill_inserted") -> str:
+        event_id = uuid.uuid4().hex
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO outbox (event_id, payment_id, amount, event, created_at) VALUES (?, ?, ?, ?, ?)",
+                (event_id, payment_id, amount, event, time.time()),
+            )
+        self.start_sender()
+        self._wake.set()
+        return event_id
+
+    def due(self, limit: int):
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, event_id, payment_id, amount, event, attempts FROM outbox "
+                "WHERE sent_at IS NULL AND dead = 0 AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit),
+            ).fetchall()
+
+    def next_due_in(self) -> float:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE sent_at IS NULL AND dead = 0"
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+
+    def _executemany(self, sql: str, params: list):
+        # one transaction (one fsync) for the whole batch
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(sql, params)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def mark_sent(self, row_ids: list):
+        now = time.time()
+        self._executemany("UPDATE outbox SET sent_at = ?, last_error = NULL WHERE id = ?",
+                          [(now, row_id) for row_id in row_ids])
+
+    def mark_failed(self, failures: list, permanent: bool = False):
+        """failures: [(row_id, attempts, error), ...]"""
+        now = time.time()
+        params = []
+        for row_id, attempts, error in failures:
+            # exponential backoff with jitter: 0.5s, 1s, 2s, ... capped at OUTBOX_BACKOFF_MAX
+            delay = min(OUTBOX_BACKOFF_MAX, 0.5 * (2 ** attempts)) * random.uniform(0.5, 1.0)
+            params.append((now + delay, error[:500], 1 if permanent else 0, row_id))
+        self._executemany(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, dead = ? WHERE id = ?",
+            params,
+        )
+
+    def requeue_dead(self, row_ids: list = None) -> int:
+        """Put parked (dead) events back in the queue, all of them or only `row_ids`."""
+        sql = "UPDATE outbox SET dead = 0, attempts = 0, next_attempt_at = 0 WHERE dead = 1 AND sent_at IS NULL"
+        params = []
+        if row_ids is not None:
+            sql += f" AND id IN ({','.join('?' * len(row_ids))})" if row_ids else " AND 0"
+            params = list(row_ids)
+        with self._lock:
+            count = self._db.execute(sql, params).rowcount
+        if count:
+            self._wake.set()
+        return count
+
+    def dead_rows(self, limit: int = 100):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, event_id, payment_id, amount, event, created_at, attempts, last_error "
+                "FROM outbox WHERE dead = 1 ORDER BY id LIMIT ?", (limit,),
+            ).fetchall()
+        keys = ("id", "event_id", "payment_id", "amount", "event", "created_at", "attempts", "last_error")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def stats(self):
+        with self._lock:
+            pending, oldest = self._db.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE sent_at IS NULL AND dead = 0"
+            ).fetchone()
+            dead = self._db.execute("SELECT COUNT(*) FROM outbox WHERE dead = 1").fetchone()[0]
+        return {
+            "pending": pending,
+            "dead": dead,
+            "oldest_pending_s": round(time.time() - oldest, 1) if oldest else None,
+        }
+
+    def start_sender(self):
+        with self._lock:
+            if self._sender is None or not self._sender.is_alive():
+                self._sender = threading.Thread(target=self._run_sender, name="outbox-sender", daemon=True)
+                self._sender.start()
+
+    def _run_sender(self):
+        while True:
+            batch = self.due(OUTBOX_BATCH)
+            if not batch:
+                wait = self.next_due_in()
+                self._wake.wait(5.0 if wait is None else min(wait, 5.0))
+                self._wake.clear()
+                continue
+            try:
+                self._send(batch)
+            except Exception as e:  # never let the sender thread die
+                print(f"[outbox] sender error: {e}")
+                time.sleep(1.0)
+
+    def _send(self, batch: list):
+        events = [
+            {"event_id": event_id, "payment_id": payment_id, "amount": amount, "event": event}
+            for _, event_id, payment_id, amount, event, _ in batch
+        ]
+        try:
+            results = post_batch_to_django(events)
+        except requests.HTTPError as e:
+            code = e.response.status_code if e.response is not None else 0
+            if code == 404:
+                # older Django without the batch endpoint: one request per event
+                return self._send_one_by_one(batch)
+            # retryable codes back off; any other 4xx will never succeed: park it for a human (see requeue_dead)
+            return self.mark_failed([(row[0], row[5], f"django_api: {e}") for row in batch], not is_retryable(e))
+        except (requests.RequestException, KeyError, ValueError) as e:
+            # Django unreachable (or garbled answer): back off the whole batch
+            return self.mark_failed([(row[0], row[5], f"django_api: {e}") for row in batch])
+
+        sent, rejected = [], []
+        for row, res in zip(batch, results):
+            if res.get("ok"):
+                sent.append(row[0])   # applied, duplicate or already paid
+            else:
+                rejected.append((row[0], row[5], f"django_api: {res.get('error')}"))
+        if sent:
+            self.mark_sent(sent)
+        if rejected:
+            # per-event validation errors (unknown payment, bad amount) are final
+            self.mark_failed(rejected, permanent=True)
+
+    def _send_one_by_one(self, batch: list):
+        for row_id, event_id, payment_id, amount, event, attempts in batch:
+            try:
+                post_to_django(payment_id, amount, event, event_id=event_id)
+                self.mark_sent([row_id])
+            except requests.HTTPError as e:
+                self.mark_failed([(row_id, attempts, f"django_api: {e}")], not is_retryable(e))
+            except requests.RequestException as e:
+                # Django unreachable: back off and stop this batch
+                self.mark_failed([(row_id, attempts, f"django_api: {e}")])
+                break
+
+outbox = Outbox(OUTBOX_PATH)
 
 @app.get("/healthz")
 def healthz():
@@ -110,8 +310,29 @@ def status():
         "serial_port": SERIAL_PORT,
         "serial_baud": SERIAL_BAUD,
         "django_api": DJANGO_API,
+        "outbox": outbox.stats(),
+        "acceptor": _acceptor.stats() if _acceptor else None,
+        "relay": relay_scheduler.stats(),
+        "http": http_client.stats(),
     })
 
+@app.get("/outbox/dead")
+def outbox_dead():
+    """Parked events (Django refused them), for a human to check before requeueing."""
+    return jsonify({"ok": True, "dead": outbox.dead_rows()})
+
+@app.post("/outbox/requeue")
+def outbox_requeue():
+    """
+    Body JSON: { "ids": [row ids] } or {} for every dead event.
+    Puts parked events back in the outbox; the sender retries them right away.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
+    if ids is not None and not (isinstance(ids, list) and all(isinstance(i, int) for i in ids)):
+        return jsonify({"ok": False, "error": "ids must be a list of int"}), 400
+    return jsonify({"ok": True, "requeued": outbox.requeue_dead(ids)})
+
 @app.post("/set-session")
 def set_session():
     global current_payment_id
@@ -128,8 +349,11 @@ def stack():
     Request stacking a bill.
     JSON body: { "bill": 500|1000|2000, "payment_id": optional }
     Behavior:
-      - In SIMULATE=1: immediately posts to Django and returns ok.
-      - In SIMULATE=0: runs serial handshake and only posts to Django on success.
+      - In SIMULATE=1: immediately queues the event for Django and returns ok.
+      - In SIMULATE=0: runs serial handshake and only queues the event on success.
+    The event is durable in the outbox before we answer; delivery to Django
+    happens in the background (see Outbox), so the response carries the
+    queued event_id instead of Django's reply.
     """
     global current_payment_id
     data = request.get_json(silent=True) or {}
@@ -149,99 +373,76 @@ def stack():
         if SIMULATE:
             # Simulate device acceptance delay
             time.sleep(0.4)
-            dj = post_to_django(pid, bill)
-            return jsonify({"ok": True, "mode": "simulate", "forwarded": dj})
+            event_id = outbox.enqueue(pid, bill)
+            return jsonify({"ok": True, "mode": "simulate", "queued": event_id})
 
         # SERIAL MODE
         ok = accept_bill_via_serial(bill)
         if not ok:
             return jsonify({"ok": False, "error": "bill rejected by device"}), 409
 
-        dj = post_to_django(pid, bill)
-        return jsonify({"ok": True, "mode": "serial", "forwarded": dj})
+        event_id = outbox.enqueue(pid, bill)
+        return jsonify({"ok": True, "mode": "serial", "queued": event_id})
 
-    except requests.RequestException as e:
-        return jsonify({"ok": False, "error": f"django_api: {e}"}), 502
+    except sqlite3.Error as e:
+        return jsonify({"ok": False, "error": f"outbox: {e}"}), 500
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-if __name__ == "__main__":
-    # Bind only locally for safety
-    app.run(host=BRIDGE_HOST, port=BRIDGE_PORT, debug=False)
-
-
-# device_bridge_server.py — extrait PSEUDO ID-003
-import time
-
-# Map "denomination code" -> montant DA (à ajuster selon ta table Algérie)
+# --- Bill acceptor (ID-003, see id003.py) ---
+# Escrow code -> montant DA (à ajuster selon la table de billets du validateur)
 DENOM_MAP = {
-    0x01: 500,
-    0x02: 1000,
-    0x03: 2000,
+    0x61: 500,
+    0x62: 1000,
+    0x63: 2000,
 }
-
-def id003_enable_only(ser, codes=(0x01, 0x02, 0x03)):
-    """
-    Envoie la commande ID-003 "Enable/Inhibit" pour autoriser uniquement les canaux passés.
-    Les octets exacts dépendent du manuel ID-003 (format, checksum).
-    Utilise Portalum.Id003 comme référence de dialogue si besoin.
-    """
-    # TODO: construire la trame Enable/Inhibit selon la spec ID-003
-    # ser.write(b'\x..\x.. ... \xCHK')  # envoyer et vérifier ACK
-    pass
-
-def id003_read_status(ser, timeout=0.5):
-    """
-    Lis et parse les messages statut (dont ESCROW).
-    Retourne par ex: ('ESCROW', code_denom) ou ('IDLE', None) etc.
-    """
-    start = time.time()
-    buf = b""
-    while time.time() - start < timeout:
-        chunk = ser.read(64)
-        if chunk:
-            buf += chunk
-            # TODO: parser selon framing ID-003 (header, length, payload, checksum)
-            # if detected_escrow:
-            #     return ('ESCROW', denom_code)
-            # elif detected_other_state:
-            #     ...
-    return ('IDLE', None)
-
-def id003_stack(ser):
-    """Envoie la commande STACK (valide uniquement en ESCROW)."""
-    # TODO: ser.write(STACK_CMD_BYTES) + lire ACK
-    pass
-
-def id003_return(ser):
-    """Envoie la commande RETURN (rend le billet en ESCROW)."""
-    # TODO: ser.write(RETURN_CMD_BYTES) + lire ACK
-    pass
-
-def accept_bill_via_serial(amount_expected: int) -> bool:
+ACCEPT_TIMEOUT = float(os.getenv("ACCEPT_TIMEOUT", "10"))   # s d'attente d'un billet par /stack
+ID003_POLL_MS  = int(os.getenv("ID003_POLL_MS", "100"))
+
+_acceptor = None
+_acceptor_lock = threading.Lock()
+_accept_lock = threading.Lock()   # une seule transaction billet à la fois
+
+def get_acceptor() -> Id003Device:
+    global _acceptor
+    with _acceptor_lock:
+        if _acceptor is None:
+            _acceptor = Id003Device(open_serial(), poll_interval=ID003_POLL_MS / 1000.0).start()
+            _acceptor.inhibit()
+        return _acceptor
+
+def accept_bill_via_serial(amount_expected: int, timeout: float = ACCEPT_TIMEOUT) -> bool:
     """
     1) Enable uniquement 500/1000/2000
-    2) Attendre ESCROW + code_denom
-    3) Si DENOM_MAP[code] == amount_expected -> STACK, sinon RETURN
-    4) Vérifier confirmation "BILL STACKED", renvoyer True si OK
+    2) Attendre ESCROW + code_denom (évènement du thread lecteur, pas de fenêtre de lecture fixe)
+    3) Si DENOM_MAP[code] == amount_expected -> STACK, sinon RETURN (et on attend le suivant)
+    4) True dès VEND_VALID (le billet est encaissé), False sur erreur / timeout
     """
-    ser = open_serial()
-    id003_enable_only(ser, (0x01, 0x02, 0x03))  # tes 3 canaux
-
-    # Boucle d’attente d’un billet en escrow
-    t0 = time.time()
-    while time.time() - t0 < 10:  # 10s max attente
-        state, denom_code = id003_read_status(ser, timeout=0.5)
-        if state == 'ESCROW' and denom_code in DENOM_MAP:
-            value = DENOM_MAP[denom_code]
-            if value == amount_expected:
-                id003_stack(ser)
-                # TODO: attendre message "STACKED" / "ACCEPTED"
-                return True
-            else:
-                id003_return(ser)
-                # Repart en attente
-    return False
+    with _accept_lock:
+        dev = get_acceptor()
+        events = dev.subscribe()
+        try:
+            dev.enable(DENOM_MAP)
+            deadline = time.monotonic() + timeout
+            while True:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                try:
+                    ev = events.get(timeout=left)
+                except queue.Empty:
+                    return False
+                if ev.name == "ESCROW":
+                    value = DENOM_MAP.get(ev.data[0]) if ev.data else None
+                    dev.send(CMD_STACK_1 if value == amount_expected else CMD_RETURN)
+                elif ev.name == "VEND_VALID":
+                    return True
+                elif ev.name in ERROR_STATES:
+                    print(f"[id003] acceptor error: {ev.name}")
+                    return False
+        finally:
+            dev.unsubscribe(events)
+            dev.inhibit()
 
 
 # device_bridge_server.py (add near the top with other config)
@@ -275,40 +476,178 @@ def relay_on_off_bytes(channel: int, on: bool) -> bytes:
     cmd = f"CH{channel}:{'ON' if on else 'OFF'}\r\n"
     return cmd.encode("ascii")
 
-def actuate_slot(channel: int, pulse_ms: int = RELAY_PULSE_MS) -> bool:
+class RelayScheduler:
     """
-    Toggle the relay for `channel` ON then OFF to open the door/solenoid.
+    Single owner of the relay serial port. Open commands are queued and a
+    writer thread turns the relay ON, then schedules its OFF on a timer heap,
+    so pulses on different channels overlap and no request thread sleeps for
+    RELAY_PULSE_MS. Commands for a channel that is already pulsing wait for
+    that pulse to end. Every command gets a job id the caller can poll.
     """
-    if SIMULATE:
-        # Simulate a small delay then success
-        time.sleep(pulse_ms / 1000.0)
+
+    KEEP_JOBS = 500  # finished jobs kept for /relay-jobs/<id>
+
+    def __init__(self, pulse_ms: int = RELAY_PULSE_MS):
+        self.pulse_ms = pulse_ms
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()          # job_id -> job dict
+        self._keys = {}                     # idempotency key -> job_id
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="relay-scheduler", daemon=True)
+                self._thread.start()
+
+    def submit(self, channel: int, pulse_ms: int = None, key: str = None) -> str:
+        """
+        Queue a pulse and return its job id. With an idempotency `key`, a
+        resubmission returns the job already known for that key (queued,
+        running or done) instead of pulsing again; only a failed one is redone.
+        """
+        with self._lock:
+            if key:
+                known = self._jobs.get(self._keys.get(key))
+                if known and known["status"] != "failed":
+                    return known["job_id"]
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {"job_id": job_id, "channel": channel, "pulse_ms": pulse_ms or self.pulse_ms,
+                                  "key": key, "status": "queued", "error": None, "queued_at": time.time(),
+                                  "on_at": None, "off_at": None}
+            if key:
+                self._keys[key] = job_id
+            while len(self._jobs) > self.KEEP_JOBS:
+                _, old = self._jobs.popitem(last=False)
+                if old["key"] and self._keys.get(old["key"]) == old["job_id"]:
+                    del self._keys[old["key"]]
+        self.start()
+        self._queue.put(job_id)
+        return job_id
+
+    def job(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"pulse_ms": self.pulse_ms, "pending": self._queue.qsize(), "jobs": counts}
+
+    # --- writer thread ---
+    def _set(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.update(fields)
+                return dict(job)
+        return None
+
+    def _write(self, channel: int, on: bool):
+        global _relay_ser
+        if SIMULATE:
+            return
+        try:
+            ser = open_relay_serial()
+            ser.write(relay_on_off_bytes(channel, on))
+            ser.flush()
+        except Exception:
+            # drop the handle so the next command reopens the port
+            _relay_ser = None
+            raise
+
+    def _start_pulse(self, job_id: str, timers: list, active: dict) -> bool:
+        """Turn the relay ON and schedule its OFF; False if the job could not start."""
+        job = self._set(job_id, status="running", on_at=time.time())
+        if job is None:
+            return False
+        try:
+            self._write(job["channel"], True)
+        except Exception as e:
+            self._set(job_id, status="failed", error=str(e))
+            return False
+        active[job["channel"]] = job_id
+        heapq.heappush(timers, (time.monotonic() + job["pulse_ms"] / 1000.0, job["channel"], job_id))
         return True
 
-    ser = open_relay_serial()
-    # Turn ON
-    ser.write(relay_on_off_bytes(channel, True))
-    ser.flush()
-    time.sleep(pulse_ms / 1000.0)
-    # Turn OFF
-    ser.write(relay_on_off_bytes(channel, False))
-    ser.flush()
-    return True
+    def _run(self):
+        timers = []      # heap of (off deadline, channel, job_id)
+        active = {}      # channel -> job_id currently ON
+        waiting = {}     # channel -> deque of job_ids behind the active pulse
+        while True:
+            timeout = max(0.0, timers[0][0] - time.monotonic()) if timers else None
+            try:
+                job_id = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                job_id = None
+
+            if job_id is not None:
+                job = self.job(job_id)
+                if job is not None:
+                    if job["channel"] in active:
+                        waiting.setdefault(job["channel"], deque()).append(job_id)
+                    else:
+                        self._start_pulse(job_id, timers, active)
+
+            now = time.monotonic()
+            while timers and timers[0][0] <= now:
+                _, channel, done_id = heapq.heappop(timers)
+                active.pop(channel, None)
+                try:
+                    self._write(channel, False)
+                    self._set(done_id, status="done", off_at=time.time())
+                except Exception as e:
+                    self._set(done_id, status="failed", error=f"OFF failed: {e}")
+                # a failed ON leaves the channel idle: go on with the next waiting job
+                while waiting.get(channel):
+                    if self._start_pulse(waiting[channel].popleft(), timers, active):
+                        break
+
+relay_scheduler = RelayScheduler()
 
 # === NEW endpoint ===
 @app.post("/open-slot")
 def open_slot():
     """
-    Body JSON: { "channel": 1..12 }
-    Pulses the relay for that channel to open the slot case.
+    Body JSON: { "channel": 1..12, "key": optional idempotency key }
+    Queues a relay pulse for that channel and answers right away with a
+    job_id; poll GET /relay-jobs/<job_id> for "done" / "failed". A repeated
+    key gets the existing job back (no second pulse) unless it failed.
     """
     data = request.get_json(silent=True) or {}
-    ch = int(data.get("channel", 0))
+    try:
+        ch = int(data.get("channel", 0))
+    except (TypeError, ValueError):
+        ch = 0
     if ch < 1 or ch > 12:
         return jsonify({"ok": False, "error": "channel must be 1..12"}), 400
-    try:
-        ok = actuate_slot(ch)
-        if not ok:
-            return jsonify({"ok": False, "error": "actuation failed"}), 500
-        return jsonify({"ok": True, "channel": ch})
-    except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 500
+    key = data.get("key")
+    job_id = relay_scheduler.submit(ch, key=str(key)[:100] if key else None)
+    job = relay_scheduler.job(job_id)
+    return jsonify({"ok": True, "channel": ch, "job_id": job_id, "status": job["status"] if job else "queued"}), 202
+
+@app.get("/relay-jobs/<job_id>")
+def relay_job(job_id):
+    job = relay_scheduler.job(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "unknown job"}), 404
+    return jsonify({"ok": job["status"] != "failed", **job})
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requeue-dead", action="store_true",
+                    help="put every dead outbox event back in the queue, then exit")
+    args = ap.parse_args()
+    if args.requeue_dead:
+        print(f"[outbox] {outbox.requeue_dead()} event(s) requeued")
+        raise SystemExit(0)
+    # Deliver anything left over from a previous run right away
+    outbox.start_sender()
+    relay_scheduler.start()
+    # Bind only locally for safety
+    app.run(host=BRIDGE_HOST, port=BRIDGE_PORT, debug=False)
@@ -0,0 +1,120 @@
+# http_pool.py
+# Shared HTTP client for the local services (device bridge, CV server) that
+# call Django. One requests.Session per process keeps TCP/TLS connections
+# alive between bills instead of opening a new one per POST, and records a
+# latency histogram per endpoint (exposed on the services' /status pages).
+#
+# ENV (optional):
+#   HTTP_POOL_SIZE=4          # kept-alive connections per host
+#   HTTP_CONNECT_TIMEOUT=2    # seconds
+#   HTTP_READ_TIMEOUT=4       # seconds (callers may pass their own)
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_POOL_SIZE       = int(os.getenv("HTTP_POOL_SIZE", "4"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "2"))
+HTTP_READ_TIMEOUT    = float(os.getenv("HTTP_READ_TIMEOUT", "4"))
+
+# 4xx that may succeed later: timeout, throttling, and a wrong/rotated API key
+# (fixed by an operator, accepted cash must not be dropped or parked for it)
+RETRY_STATUS = frozenset({401, 403, 408, 429})
+
+# Upper bounds (ms) of the histogram buckets; the last bucket is "+inf"
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram (cheap enough to update on every call)."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float, ok: bool = True):
+        self.buckets[bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if not ok:
+            self.errors += 1
+
+    def snapshot(self):
+        labels = [f"<={b}" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "max_ms": round(self.max_ms, 1),
+            "buckets_ms": dict(zip(labels, self.buckets)),
+        }
+
+
+class PooledClient:
+    """
+    Keep-alive, connection-pooled HTTP client shared by every thread of the
+    process. Only connect/read timeouts are set here; retries are the
+    caller's business (see the bridge outbox and is_retryable).
+    """
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE,
+                 connect_timeout: float = HTTP_CONNECT_TIMEOUT,
+                 read_timeout: float = HTTP_READ_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def request(self, method: str, url: str, endpoint: str = None, timeout: float = None, **kwargs):
+        """Like requests.request; `timeout` is the read timeout (connect timeout is fixed)."""
+        key = endpoint or f"{method.upper()} {urlsplit(url).path}"
+        ok = False
+        t0 = time.perf_counter()
+        try:
+            r = self._session.request(
+                method, url, timeout=(self.connect_timeout, timeout or self.read_timeout), **kwargs
+            )
+            ok = r.status_code < 500
+            return r
+        finally:
+            ms = (time.perf_counter() - t0) * 1000.0
+            with self._lock:
+                self._histograms.setdefault(key, LatencyHistogram()).observe(ms, ok)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return {key: h.snapshot() for key, h in self._histograms.items()}
+
+
+def is_retryable(e: requests.RequestException) -> bool:
+    """
+    True if the same request may succeed later: no HTTP answer (network
+    error), a 5xx, or one of RETRY_STATUS. Any other 4xx means Django refused
+    the request itself and retrying it cannot help.
+    """
+    response = getattr(e, "response", None)
+    code = response.status_code if response is not None else 0
+    return code == 0 or code >= 500 or code in RETRY_STATUS
+
+
+# One client per process
+http_client = PooledClient()
@@ -0,0 +1,261 @@
+# id003.py
+# Streaming ID-003 (JCM) protocol layer for the bill acceptor, shared by
+# device_bridge_server.py and device_bridge.py.
+#
+# Frame (both directions):  SYNC(0xFC) LNG CMD [DATA...] CRCL CRCH
+#   LNG = whole frame length, SYNC and CRC included (5..MAX_FRAME here)
+#   CRC = CRC-16/Kermit (poly 0x1021 reflected, init 0) over SYNC..DATA, little-endian
+#
+# The acceptor only talks when polled: the device thread sends STATUS REQUEST
+# every `poll_interval` and each answer is one status frame. Serial reads land
+# directly in a preallocated buffer (readinto on a memoryview) and frames are
+# checked and sliced in place; only the few DATA bytes of a frame are copied.
+
+import queue
+import threading
+import time
+from collections import namedtuple
+
+SYNC = 0xFC
+MIN_FRAME = 5
+MAX_FRAME = 64   # longest answer we handle; a bigger LNG means a false SYNC
+
+# --- acceptor -> host (status / power-up / error) ---
+STATUS_NAMES = {
+    0x11: "IDLING",
+    0x12: "ACCEPTING",
+    0x13: "ESCROW",          # DATA[0] = denomination code
+    0x14: "STACKING",
+    0x15: "VEND_VALID",      # host must ACK
+    0x16: "STACKED",
+    0x17: "REJECTING",       # DATA[0] = reject reason
+    0x18: "RETURNING",
+    0x19: "HOLDING",
+    0x1A: "DISABLED",
+    0x1B: "INITIALIZE",
+    0x40: "POWER_UP",
+    0x41: "POWER_UP_BILL_IN_ACCEPTOR",
+    0x42: "POWER_UP_BILL_IN_STACKER",
+    0x43: "STACKER_FULL",
+    0x44: "STACKER_OPEN",
+    0x45: "JAM_IN_ACCEPTOR",
+    0x46: "JAM_IN_STACKER",
+    0x47: "PAUSE",
+    0x48: "CHEATED",
+    0x49: "FAILURE",
+    0x4A: "COMMUNICATION_ERROR",
+    0x4B: "INVALID_COMMAND",
+    0x50: "ACK",
+}
+ERROR_STATES = {"STACKER_FULL", "STACKER_OPEN", "JAM_IN_ACCEPTOR", "JAM_IN_STACKER",
+                "CHEATED", "FAILURE", "COMMUNICATION_ERROR"}
+
+# --- host -> acceptor ---
+CMD_STATUS_REQUEST = 0x11
+CMD_RESET          = 0x40
+CMD_STACK_1        = 0x41
+CMD_STACK_2        = 0x42
+CMD_RETURN         = 0x43
+CMD_HOLD           = 0x44
+CMD_WAIT           = 0x45
+CMD_ACK            = 0x50
+CMD_SET_ENABLE     = 0xC0   # DATA = 2-byte denomination mask, bit set = denomination disabled
+CMD_SET_INHIBIT    = 0xC3   # DATA = 0x00 accept, 0x01 inhibit
+
+# Escrow denomination codes 0x61.. map to bit 0.. of the enable mask
+DENOM_CODE_BASE = 0x61
+
+Event = namedtuple("Event", "name code data ts")
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x8408 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+_CRC_TABLE = _crc_table()
+
+
+def crc16(data) -> int:
+    """CRC-16/Kermit of a bytes-like object (memoryview slices are not copied)."""
+    crc = 0
+    for b in data:
+        crc = (crc >> 8) ^ _CRC_TABLE[(crc ^ b) & 0xFF]
+    return crc
+
+
+def build_frame(cmd: int, data: bytes = b"") -> bytes:
+    body = bytes((SYNC, MIN_FRAME + len(data), cmd)) + bytes(data)
+    crc = crc16(body)
+    return body + bytes((crc & 0xFF, crc >> 8))
+
+
+def enable_mask(codes) -> bytes:
+    """SET_ENABLE payload that leaves only the given escrow codes enabled."""
+    mask = 0xFFFF
+    for code in codes:
+        mask &= ~(1 << (code - DENOM_CODE_BASE))
+    return bytes((mask & 0xFF, mask >> 8))
+
+
+class FrameBuffer:
+    """
+    Preallocated receive buffer. The serial port writes into writable() and
+    frames() parses complete frames in place; consumed bytes are dropped by
+    moving the start index, and the unread tail (less than one frame) is
+    compacted to the front only when the free space runs out.
+    """
+
+    def __init__(self, size: int = 1024):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+        self.bad_crc = 0
+        self.dropped = 0
+
+    def writable(self) -> memoryview:
+        if self._end == len(self._buf):
+            if self._start == 0:            # full and still no frame: that SYNC was noise
+                self._start = 1
+                self.dropped += 1
+            pending = self._end - self._start
+            self._mv[:pending] = self._mv[self._start:self._end]
+            self._start, self._end = 0, pending
+        return self._mv[self._end:]
+
+    def commit(self, n: int):
+        self._end += n
+
+    def frames(self):
+        """Yield (cmd, data) for every complete, CRC-valid frame; resyncs on garbage."""
+        buf, mv = self._buf, self._mv
+        while True:
+            i = buf.find(SYNC, self._start, self._end)
+            if i < 0:
+                self.dropped += self._end - self._start
+                self._start = self._end = 0
+                return
+            if i > self._start:
+                self.dropped += i - self._start
+                self._start = i
+            if self._end - i < 2:
+                return
+            lng = buf[i + 1]
+            if lng < MIN_FRAME or lng > MAX_FRAME:
+                self.dropped += 1
+                self._start = i + 1
+                continue
+            if self._end - i < lng:
+                return
+            crc = buf[i + lng - 2] | (buf[i + lng - 1] << 8)
+            if crc16(mv[i:i + lng - 2]) != crc:
+                self.bad_crc += 1
+                self._start = i + 1        # maybe that SYNC was data: rescan after it
+                continue
+            self._start = i + lng
+            yield buf[i + 2], bytes(mv[i + 3:i + lng - 2])
+
+
+class Id003Device:
+    """
+    Owns the acceptor serial port: a single thread sends the status polls and
+    queued commands, reads whatever bytes are available into a FrameBuffer
+    and publishes one Event per status frame to the subscribers' queues.
+    VEND_VALID is ACKed here, as the protocol requires.
+    """
+
+    def __init__(self, ser, poll_interval: float = 0.1):
+        self.ser = ser
+        self.poll_interval = poll_interval
+        self.last_event = None
+        self.frames = 0
+        self.errors = 0
+        self._rx = FrameBuffer()
+        self._commands = queue.Queue()
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="id003-reader", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    def send(self, cmd: int, data: bytes = b""):
+        """Queue a command; it is written by the device thread between two polls."""
+        self._commands.put(build_frame(cmd, data))
+
+    def enable(self, codes):
+        self.send(CMD_SET_ENABLE, enable_mask(codes))
+        self.send(CMD_SET_INHIBIT, b"\x00")
+
+    def inhibit(self):
+        self.send(CMD_SET_INHIBIT, b"\x01")
+
+    def subscribe(self) -> queue.Queue:
+        q = queue.Queue(maxsize=256)
+        with self._lock:
+            self._subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def stats(self):
+        return {
+            "last_status": self.last_event.name if self.last_event else None,
+            "frames": self.frames,
+            "bad_crc": self._rx.bad_crc,
+            "dropped_bytes": self._rx.dropped,
+            "errors": self.errors,
+        }
+
+    def _publish(self, event: Event):
+        self.last_event = event
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass  # a stalled subscriber must not block the port
+
+    def _run(self):
+        next_poll = 0.0
+        while not self._stop_event.is_set():
+            try:
+                now = time.monotonic()
+                try:
+                    self.ser.write(self._commands.get_nowait())
+                except queue.Empty:
+                    if now >= next_poll:
+                        self.ser.write(build_frame(CMD_STATUS_REQUEST))
+                        next_poll = now + self.poll_interval
+                # read what is there, or block (up to ser.timeout) for the first byte
+                mv = self._rx.writable()
+                n = self.ser.readinto(mv[:max(1, min(len(mv), self.ser.in_waiting))])
+                if not n:
+                    continue
+                self._rx.commit(n)
+                for code, data in self._rx.frames():
+                    self.frames += 1
+                    if code == 0x15:
+                        self.ser.write(build_frame(CMD_ACK))
+                    self._publish(Event(STATUS_NAMES.get(code, f"0x{code:02X}"), code, data, time.time()))
+            except Exception as e:
+                self.errors += 1
+                print(f"[id003] serial error: {e}")
+                time.sleep(0.5)
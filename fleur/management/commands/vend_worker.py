@@ -0,0 +1,36 @@
+# fleur/management/commands/vend_worker.py
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from fleur.vending import claim_job, requeue_stale, run_job
+
+
+class Command(BaseCommand):
+    help = "Worker de la file VendJob: ouvre les slots des commandes payées via le bridge."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--poll", type=float, default=0.5, help="attente (s) quand la file est vide")
+        parser.add_argument("--once", action="store_true", help="vide la file puis s'arrête")
+
+    def handle(self, *args, poll, once, **options):
+        self.stdout.write(f"[vend] worker démarré (poll {poll}s)")
+        last_sweep = 0.0
+        while True:
+            close_old_connections()
+            if time.monotonic() - last_sweep > 10:
+                n = requeue_stale()
+                if n:
+                    self.stdout.write(f"[vend] {n} tâche(s) orpheline(s) remise(s) en file")
+                last_sweep = time.monotonic()
+
+            job = claim_job()
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll)
+                continue
+            status = run_job(job)
+            self.stdout.write(f"[vend] job #{job.pk} order #{job.order_id} canal {job.channel}: "
+                              f"{status} (essai {job.attempts})")
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:48
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def backfill_done_jobs(apps, schema_editor):
+    # commandes déjà servies avant la file: tâche DONE, payment_success n'en recrée pas
+    Order = apps.get_model("fleur", "Order")
+    VendJob = apps.get_model("fleur", "VendJob")
+    VendJob.objects.bulk_create(
+        [VendJob(order_id=pk, status="DONE") for pk in Order.objects.filter(vended=True).values_list("pk", flat=True)],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fleur', '0007_paymentevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VendJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.PositiveIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('QUEUED', 'En file'), ('RUNNING', 'En cours'), ('DONE', 'Servi'), ('FAILED', 'Échec')], default='QUEUED', max_length=12)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.CharField(blank=True, max_length=255)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='vend_job', to='fleur.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='fleur_vendj_status_a46d18_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_done_jobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:54
+
+from django.db import migrations
+
+
+def create_home_content(apps, schema_editor):
+    # la ligne unique existe avant le premier GET: plus de create() dans une vue
+    HomeContent = apps.get_model("fleur", "HomeContent")
+    if not HomeContent.objects.exists():
+        HomeContent.objects.create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fleur', '0008_vendjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_home_content, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:55
+
+from django.db import migrations
+
+# SQL recopié de fleur/search.py (une migration ne doit pas dépendre du code courant)
+PG_VECTOR = (
+    "setweight(to_tsvector('simple'::regconfig, coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple'::regconfig, coalesce(description, '')), 'B')"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS fleur_product_fts USING fts5("
+            "name, description, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            "INSERT INTO fleur_product_fts (rowid, name, description) "
+            "SELECT id, name, description FROM fleur_product"
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute(
+            f"CREATE INDEX IF NOT EXISTS fleur_product_search_gin ON fleur_product USING gin (({PG_VECTOR}))"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS fleur_product_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS fleur_product_search_gin")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fleur', '0009_homecontent_singleton'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.2.7 on 2026-10-18 00:57
+
+from django.db import migrations, models
+
+# anciennes valeurs écrites en base ("NEW"/"PAID" en dur, libellés OrderStatus) -> codes
+STATUS_CODES = {
+    "NEW": "PENDING_PAYMENT",
+    "En attente paiement": "PENDING_PAYMENT",
+    "Payée": "PAID",
+    "Échouée": "FAILED",
+}
+LEGACY_VALUES = {"PENDING_PAYMENT": "NEW", "PAID": "PAID", "FAILED": "Échouée"}
+
+
+def normalize_status(apps, schema_editor):
+    Order = apps.get_model("fleur", "Order")
+    for old, code in STATUS_CODES.items():
+        Order.objects.filter(status=old).update(status=code)
+
+
+def restore_status(apps, schema_editor):
+    Order = apps.get_model("fleur", "Order")
+    for code, old in LEGACY_VALUES.items():
+        Order.objects.filter(status=code).update(status=old)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fleur', '0011_order_created_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_status, restore_status),
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('PENDING_PAYMENT', 'En attente paiement'), ('PAID', 'Payée'), ('FAILED', 'Échouée')], default='PENDING_PAYMENT', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='order_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['slot', 'vended'], name='order_slot_vended_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'created_at'], name='payment_status_created_idx'),
+        ),
+    ]
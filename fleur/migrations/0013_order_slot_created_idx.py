@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7 on 2026-10-18 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fleur', '0012_order_status_normalize_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['slot', 'created_at', 'id'], name='order_slot_created_idx'),
+        ),
+    ]
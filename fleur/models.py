@@ -1,6 +1,8 @@
 # fleur/models.py
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
 from django.urls import reverse
+from django.utils import timezone
 
 # fleur/models.py
 from django.db import models
@@ -22,10 +24,47 @@ class HomeContent(models.Model):
     def __str__(self):
         return "Contenu d’accueil"
 
+    # Copie de la ligne gardée par process: (stamp, instance). Le stamp partagé
+    # entre workers (cache Django) est l'updated_at de la ligne: tant qu'il ne
+    # change pas, get_solo() ne touche pas la base.
+    SOLO_STAMP_KEY = "homecontent:stamp"
+    _solo_memo = None
+
     @classmethod
-    def get_solo(cls):
-        obj = cls.objects.first()
-        return obj or cls.objects.create()
+    def get_solo(cls, fresh=False):
+        """
+        La ligne unique du contenu d'accueil (créée par la migration 0009).
+        fresh=True relit la base et renvoie une instance à part (formulaire
+        d'édition: un formulaire invalide ne doit pas modifier la copie partagée).
+        """
+        stamp = cache.get(cls.SOLO_STAMP_KEY)
+        memo = cls._solo_memo
+        if not fresh and memo is not None and stamp is not None and memo[0] == stamp:
+            return memo[1]
+
+        obj = cls.objects.order_by("pk").first()
+        if obj is None:
+            # base créée sans la migration de données: pk fixe, un seul worker gagne
+            obj, _ = cls.objects.get_or_create(pk=1)
+        stamp = obj.updated_at.isoformat()
+        # add(): ne pas écraser le stamp plus récent posé par un save() concurrent
+        cache.add(cls.SOLO_STAMP_KEY, stamp, None)
+        if fresh:
+            return obj
+        cls._solo_memo = (stamp, obj)
+        return obj
+
+    # Stamp posé au commit: un save() annulé ne doit pas laisser un stamp
+    # qu'aucune ligne ne porte (get_solo relirait alors la base à chaque appel).
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        stamp = self.updated_at.isoformat()
+        transaction.on_commit(lambda: cache.set(self.SOLO_STAMP_KEY, stamp, None))
+
+    def delete(self, *args, **kwargs):
+        res = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: cache.delete(self.SOLO_STAMP_KEY))
+        return res
 
     def best_video_src(self):
         if self.video_file:
@@ -87,18 +126,30 @@ class Slot(models.Model):
    
 
 class OrderStatus(models.TextChoices):
-    PENDING_PAYMENT = "En attente paiement", "En attente paiement"
-    PAID = "Payée", "Payée"
-    FAILED = "Échouée", "Échouée"
+    PENDING_PAYMENT = "PENDING_PAYMENT", "En attente paiement"
+    PAID = "PAID", "Payée"
+    FAILED = "FAILED", "Échouée"
 
 class Order(models.Model):
     product = models.ForeignKey("fleur.Product", on_delete=models.PROTECT, related_name="orders")
     slot = models.ForeignKey("fleur.Slot", null=True, blank=True, on_delete=models.SET_NULL, related_name="orders")
     unit_price = models.DecimalField(max_digits=10, decimal_places=2)  # NOT NULL
     quantity = models.PositiveIntegerField(default=1)
-    status = models.CharField(max_length=20, default="NEW")
+    status = models.CharField(max_length=20, choices=OrderStatus.choices, default=OrderStatus.PENDING_PAYMENT)
     vended = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # pagination par clé du back-office (order_list), avec ou sans filtre statut
+            models.Index(fields=["created_at", "id"], name="order_created_id_idx"),
+            models.Index(fields=["status", "created_at", "id"], name="order_status_created_idx"),
+            # commandes d'un casier pas encore servies
+            models.Index(fields=["slot", "vended"], name="order_slot_vended_idx"),
+            # recherche par casier du back-office, paginée comme la liste
+            models.Index(fields=["slot", "created_at", "id"], name="order_slot_created_idx"),
+        ]
+
     def __str__(self):
         return f"Order #{self.pk} - {self.product.name} - {self.status}"
 
@@ -116,6 +167,9 @@ class Payment(models.Model):
     status = models.CharField(max_length=12, choices=PaymentStatus.choices, default=PaymentStatus.PENDING)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [models.Index(fields=["status", "created_at"], name="payment_status_created_idx")]
+
     def remaining(self):
         return max(self.amount_due - self.amount_inserted, 0)
     def change(self):
@@ -123,4 +177,41 @@ class Payment(models.Model):
         return extra if extra > 0 else 0
     def __str__(self):
         return f"Payment #{self.pk} for Order #{self.order_id} - {self.status}"
-    
+
+
+class PaymentEvent(models.Model):
+    """Billet crédité sur un paiement; `event_id` = clé d'idempotence envoyée par le bridge/la caméra."""
+    event_id = models.CharField(max_length=64, unique=True)
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="events")
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    event = models.CharField(max_length=32, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Event {self.event_id} +{self.amount} DA on Payment #{self.payment_id}"
+
+
+class VendJobStatus(models.TextChoices):
+    QUEUED = "QUEUED", "En file"
+    RUNNING = "RUNNING", "En cours"
+    DONE = "DONE", "Servi"
+    FAILED = "FAILED", "Échec"
+
+
+class VendJob(models.Model):
+    """Ouverture du slot d'une commande payée, exécutée par `manage.py vend_worker` (une seule par commande)."""
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name="vend_job")
+    channel = models.PositiveIntegerField(null=True, blank=True)  # relais du bridge; vide = pas de slot physique
+    status = models.CharField(max_length=12, choices=VendJobStatus.choices, default=VendJobStatus.QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+    run_after = models.DateTimeField(default=timezone.now)    # prochain essai (backoff)
+    locked_at = models.DateTimeField(null=True, blank=True)   # pris par un worker
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "run_after"])]
+
+    def __str__(self):
+        return f"VendJob #{self.pk} for Order #{self.order_id} - {self.status}"
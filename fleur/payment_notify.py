@@ -0,0 +1,98 @@
+# fleur/payment_notify.py
+"""
+Réveil des écrans de paiement en attente (long-poll de payment_status).
+
+payment_insert_event appelle notify_payment() après le commit: les requêtes
+en attente dans wait_payment() sur ce paiement repartent tout de suite au
+lieu d'attendre un timer. L'attente est une coroutine (un simple
+asyncio.Event par connexion, pas un thread).
+
+Avec plusieurs workers, le crédit peut être appliqué par un autre process:
+notify_payment() pose aussi un tampon dans le cache partagé (CACHES, fichiers
+sur le disque du serveur), que l'attente lit toutes les LONGPOLL_STAMP_POLL
+secondes (une lecture de cache, pas de requête SQL). En dernier recours
+(cache non partagé, p. ex. LocMemCache), la base est relue toutes les
+LONGPOLL_RECHECK secondes.
+"""
+import asyncio
+import threading
+import time
+
+from django.core.cache import cache
+
+LONGPOLL_TIMEOUT = 25.0     # s avant de répondre 304 (le client relance aussitôt)
+LONGPOLL_RECHECK = 5.0      # s entre deux relectures de la base pendant l'attente
+LONGPOLL_STAMP_POLL = 0.5   # s entre deux lectures du tampon partagé
+STAMP_KEY = "payment:stamp:{}"
+
+_lock = threading.Lock()
+_waiters = {}             # payment_id -> {(boucle asyncio, Event)}
+
+
+def notify_payment(payment_id):
+    """Signale un changement de montant / statut du paiement (depuis n'importe quel thread)."""
+    try:
+        cache.set(STAMP_KEY.format(payment_id), time.time_ns(), LONGPOLL_TIMEOUT * 4)
+    except Exception:
+        pass  # le réveil local et la relecture LONGPOLL_RECHECK suffisent
+    with _lock:
+        waiters = list(_waiters.get(payment_id, ()))
+    for loop, event in waiters:
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # boucle déjà fermée: la requête est terminée
+
+
+async def wait_payment(payment_id, read_state, since, timeout=None, recheck=None):
+    """
+    Attend que `await read_state()` (-> (version, data) ou None) renvoie une
+    version != since. Retourne (version, data) dès le changement, ou l'état
+    courant au bout de `timeout`. read_state() est rappelé sur réveil local,
+    sur changement du tampon partagé, ou toutes les `recheck` secondes.
+    """
+    timeout = LONGPOLL_TIMEOUT if timeout is None else timeout
+    recheck = LONGPOLL_RECHECK if recheck is None else recheck
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+    me = (loop, event)
+    # inscription AVANT la première lecture: aucun notify ne peut être perdu
+    with _lock:
+        _waiters.setdefault(payment_id, set()).add(me)
+    try:
+        key = STAMP_KEY.format(payment_id)
+        stamp = await _read_stamp(key)
+        deadline = loop.time() + timeout
+        while True:
+            event.clear()
+            state = await read_state()
+            left = deadline - loop.time()
+            if state is None or state[0] != since or left <= 0:
+                return state
+            reread_at = loop.time() + min(left, recheck)
+            while True:
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(LONGPOLL_STAMP_POLL, reread_at - loop.time()))
+                    break                                   # notify dans ce process
+                except asyncio.TimeoutError:
+                    pass
+                current = await _read_stamp(key)
+                if current != stamp:
+                    stamp = current
+                    break                                   # notify dans un autre process
+                if loop.time() >= reread_at:
+                    break
+    finally:
+        with _lock:
+            waiters = _waiters.get(payment_id)
+            if waiters is not None:
+                waiters.discard(me)
+                if not waiters:
+                    del _waiters[payment_id]
+
+
+async def _read_stamp(key):
+    try:
+        return await cache.aget(key)
+    except Exception:
+        return None
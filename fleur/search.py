@@ -0,0 +1,116 @@
+# fleur/search.py
+"""
+Recherche plein texte des produits (boutique, recherche "au fil de la frappe").
+
+- SQLite: table FTS5 `fleur_product_fts` (rowid = id produit), tenue à jour
+  par les signaux post_save / post_delete de Product; classement bm25 (le
+  nom pèse plus que la description).
+- Postgres: index GIN sur l'expression tsvector ci-dessous (config 'simple',
+  nom en poids A, description en B); rien à maintenir, classement ts_rank.
+  Attention: 'simple' ne retire pas les accents ("rosé" ne trouve pas
+  "rose"), contrairement à FTS5 (remove_diacritics) côté SQLite; il faudrait
+  l'extension unaccent (et une fonction IMMUTABLE pour l'index).
+- Autre base (ou FTS indisponible): repli sur icontains.
+
+Chaque mot de la recherche est pris comme préfixe ("ros" trouve "roses"),
+tous les mots doivent être présents. Seuls les produits actifs (et de la
+catégorie demandée) sont classés: le filtre est dans la requête classée,
+avant le LIMIT. Les tables/index sont créés par la migration
+0010_product_search.
+"""
+import re
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Case, IntegerField, Q, When
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Product
+
+FTS_TABLE = "fleur_product_fts"
+MAX_RESULTS = 200
+
+PG_VECTOR = (
+    "setweight(to_tsvector('simple'::regconfig, coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('simple'::regconfig, coalesce(description, '')), 'B')"
+)
+
+
+def _terms(q):
+    return re.findall(r"\w+", q.lower())
+
+
+def _ranked_ids(terms, category_id=None):
+    """
+    Ids des produits actifs correspondants (de la catégorie `category_id` si
+    donnée), du plus pertinent au moins pertinent (None = pas de moteur).
+    """
+    where, params = "p.is_active = %s", [True]
+    if category_id is not None:
+        where += " AND p.category_id = %s"
+        params.append(category_id)
+    with connection.cursor() as cur:
+        if connection.vendor == "sqlite":
+            match = " ".join(f'"{t}"*' for t in terms)
+            cur.execute(
+                f"SELECT p.id FROM {FTS_TABLE} JOIN fleur_product p ON p.id = {FTS_TABLE}.rowid "
+                f"WHERE {FTS_TABLE} MATCH %s AND {where} "
+                f"ORDER BY bm25({FTS_TABLE}, 10.0, 1.0) LIMIT %s",
+                [match, *params, MAX_RESULTS],
+            )
+        elif connection.vendor == "postgresql":
+            tsquery = " & ".join(f"{t}:*" for t in terms)
+            cur.execute(
+                f"SELECT p.id FROM fleur_product p WHERE ({PG_VECTOR}) @@ to_tsquery('simple', %s) "
+                f"AND {where} "
+                f"ORDER BY ts_rank(({PG_VECTOR}), to_tsquery('simple', %s)) DESC LIMIT %s",
+                [tsquery, *params, tsquery, MAX_RESULTS],
+            )
+        else:
+            return None
+        return [row[0] for row in cur.fetchall()]
+
+
+def search_products(queryset, q, category=None):
+    """
+    Filtre `queryset` (produits actifs, éventuellement déjà restreints à
+    `category`) sur la recherche `q` et le trie par pertinence.
+    """
+    terms = _terms(q)
+    if not terms:
+        return queryset.none()
+    try:
+        ids = _ranked_ids(terms, category.pk if category is not None else None)
+    except DatabaseError:
+        ids = None   # table FTS absente (migration non jouée / SQLite sans FTS5)
+    if ids is None:
+        return queryset.filter(Q(name__icontains=q) | Q(description__icontains=q))
+    if not ids:
+        return queryset.none()
+    rank = Case(*[When(pk=pk, then=i) for i, pk in enumerate(ids)], output_field=IntegerField())
+    return queryset.filter(pk__in=ids).order_by(rank)
+
+
+# --- index SQLite incrémental ---
+@receiver(post_save, sender=Product, dispatch_uid="product_search_save")
+def _index_product(sender, instance, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [instance.pk])
+            cur.execute(f"INSERT INTO {FTS_TABLE} (rowid, name, description) VALUES (%s, %s, %s)",
+                        [instance.pk, instance.name, instance.description])
+    except DatabaseError:
+        pass   # table FTS absente: la recherche se rabat sur icontains
+
+
+@receiver(post_delete, sender=Product, dispatch_uid="product_search_delete")
+def _unindex_product(sender, instance, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    try:
+        with transaction.atomic(), connection.cursor() as cur:
+            cur.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [instance.pk])
+    except DatabaseError:
+        pass
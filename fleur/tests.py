@@ -1,3 +1,649 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+import requests
+
+from django.db import connection
+from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import QuerySet
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import payment_notify, views
+from .api import _apply_event_atomic, _apply_events
+from .catalogue_cache import catalogue_version
+from .id003 import CMD_ACK, FrameBuffer, SYNC, build_frame, crc16
+from .models import (
+    Category, HomeContent, Order, OrderStatus, Payment, PaymentEvent, PaymentStatus, Product, Slot,
+    VendJob, VendJobStatus,
+)
+from .payment_notify import STAMP_KEY, notify_payment, wait_payment
+from .search import search_products
+from .vending import claim_job, enqueue_vend, requeue_stale, run_job
+
+
+class HotQueryPlanTests(TestCase):
+    """
+    Les requêtes fréquentes du back-office / de l'admin doivent passer par un
+    index (composite) et non par un parcours complet de la table.
+    """
+
+    def plan(self, queryset):
+        if connection.vendor == "postgresql":
+            # table presque vide: sans ça Postgres préfère toujours le seq scan
+            with connection.cursor() as cur:
+                cur.execute("SET LOCAL enable_seqscan = off")
+        return queryset.explain()
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = self.plan(queryset)
+        if connection.vendor == "sqlite":
+            self.assertNotRegex(plan, r"SCAN fleur_(order|payment)\b", plan)
+            self.assertIn(index_name, plan)
+        elif connection.vendor == "postgresql":
+            self.assertNotIn("Seq Scan", plan, plan)
+        else:
+            self.skipTest(f"plan non vérifié pour {connection.vendor}")
+
+    def test_orders_by_status_newest_first(self):
+        qs = Order.objects.filter(status=OrderStatus.PAID).order_by("-created_at", "-id")[:50]
+        self.assertUsesIndex(qs, "order_status_created_idx")
+
+    def test_orders_page_after_cursor(self):
+        qs = Order.objects.filter(created_at__lt=timezone.now()).order_by("-created_at", "-id")[:50]
+        self.assertUsesIndex(qs, "order_created_id_idx")
+
+    def test_orders_of_slot_newest_first(self):
+        qs = Order.objects.filter(slot_id=1).order_by("-created_at", "-id")[:50]
+        self.assertUsesIndex(qs, "order_slot_created_idx")
+
+    def test_slot_orders_not_vended(self):
+        qs = Order.objects.filter(slot_id=1, vended=False)
+        self.assertUsesIndex(qs, "order_slot_vended_idx")
+
+    def test_payments_by_status(self):
+        qs = Payment.objects.filter(status=PaymentStatus.PENDING).order_by("-created_at")
+        self.assertUsesIndex(qs, "payment_status_created_idx")
+
+
+class ProductSearchTests(TestCase):
+    """Le LIMIT de la requête classée s'applique après is_active / catégorie."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.roses = Category.objects.create(name="Roses", slug="roses")
+        cls.other = Category.objects.create(name="Autres", slug="autres")
+        for i in range(3):   # mieux classés (nom) mais inactifs
+            Product.objects.create(category=cls.roses, name=f"Rose {i}", slug=f"rose-{i}",
+                                   price=500, is_active=False)
+        Product.objects.create(category=cls.other, name="Rose blanche", slug="rose-blanche", price=500)
+        cls.bouquet = Product.objects.create(category=cls.roses, name="Bouquet", slug="bouquet",
+                                             description="roses rouges", price=1000)
+
+    def search(self, q, category=None):
+        qs = Product.objects.filter(is_active=True)
+        if category is not None:
+            qs = qs.filter(category=category)
+        with mock.patch("fleur.search.MAX_RESULTS", 2):
+            return [p.slug for p in search_products(qs, q, category)]
+
+    def test_inactive_products_do_not_use_up_the_limit(self):
+        self.assertEqual(self.search("rose"), ["rose-blanche", "bouquet"])
+
+    def test_category_filtered_before_the_limit(self):
+        self.assertEqual(self.search("rose", self.roses), ["bouquet"])
+
+
+class PaymentEventTests(TestCase):
+    """Crédit des billets: idempotence par event_id et passage à SUCCEEDED unique."""
+
+    def setUp(self):
+        cat = Category.objects.create(name="Roses", slug="roses")
+        product = Product.objects.create(category=cat, name="Rose", slug="rose", price=1500)
+        self.order = Order.objects.create(product=product, unit_price=1500)
+        self.payment = Payment.objects.create(order=self.order, amount_due=1500)
+
+    def credit(self, amount, event_id):
+        return _apply_event_atomic(self.payment.pk, amount, "bill_inserted", event_id)
+
+    def test_replayed_event_id_is_credited_once(self):
+        self.assertEqual(self.credit(500, "ev-1")["status"], "applied")
+        res = self.credit(500, "ev-1")
+        self.assertEqual(res, {"ok": True, "status": "duplicate", "completed": False})
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.amount_inserted, 500)
+        self.assertEqual(PaymentEvent.objects.filter(payment=self.payment).count(), 1)
+
+    def test_succeeded_transition_happens_once(self):
+        with self.captureOnCommitCallbacks() as notified:
+            first = self.credit(1000, "ev-1")
+            second = self.credit(1000, "ev-2")
+            third = self.credit(1000, "ev-3")
+        self.assertEqual((first["status"], first["completed"]), ("applied", False))
+        self.assertEqual((second["status"], second["completed"]), ("applied", True))
+        self.assertEqual(third["status"], "already_paid")
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.payment.status, PaymentStatus.SUCCEEDED)
+        self.assertEqual(self.payment.amount_inserted, 2000)   # pas de crédit après SUCCEEDED
+        self.assertEqual(self.order.status, OrderStatus.PAID)
+        self.assertEqual(len(notified), 2)                      # un réveil par crédit appliqué
+
+    def test_batch_with_invalid_events(self):
+        results = _apply_events([
+            {"event_id": "ev-1", "payment_id": self.payment.pk, "amount": 500},
+            {"payment_id": self.payment.pk, "amount": 500},                     # sans event_id
+            {"event_id": "ev-2", "payment_id": self.payment.pk, "amount": "abc"},
+            {"event_id": "ev-3", "payment_id": 999999, "amount": 500},
+            "pas un dict",
+            {"event_id": "ev-1", "payment_id": self.payment.pk, "amount": 500},  # rejoué
+            {"event_id": "ev-4", "payment_id": self.payment.pk, "amount": 1000},
+        ])
+        self.assertEqual([r.get("status", r.get("error")) for r in results], [
+            "applied", "event_id required", "invalid amount", "payment not found",
+            "event_id required", "duplicate", "applied",
+        ])
+        self.assertTrue(results[-1]["completed"])
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.amount_inserted, 1500)
+        self.assertEqual(self.payment.status, PaymentStatus.SUCCEEDED)
+        self.assertEqual(set(PaymentEvent.objects.values_list("event_id", flat=True)), {"ev-1", "ev-4"})
+
+
+class Id003FrameBufferTests(SimpleTestCase):
+    """Découpage des trames ID-003: CRC, resynchronisation, trames en morceaux."""
+
+    STACKED = build_frame(0x16)
+    ESCROW = build_frame(0x13, b"\x62")
+
+    def feed(self, fb, data, chunk=None):
+        """Écrit `data` comme le ferait readinto (par morceaux de `chunk`) et renvoie les trames."""
+        out, chunk, i = [], chunk or len(data), 0
+        while i < len(data):
+            mv = fb.writable()
+            n = min(chunk, len(mv), len(data) - i)
+            mv[:n] = data[i:i + n]
+            fb.commit(n)
+            i += n
+            out.extend(fb.frames())
+        return out
+
+    def test_crc16_kermit(self):
+        self.assertEqual(crc16(b"123456789"), 0x2189)
+        self.assertEqual(self.ESCROW[:3], bytes((SYNC, 6, 0x13)))
+
+    def test_bad_crc_is_rejected(self):
+        bad = bytearray(self.ESCROW)
+        bad[-1] ^= 0xFF
+        fb = FrameBuffer()
+        self.assertEqual(self.feed(fb, bytes(bad) + self.STACKED), [(0x16, b"")])
+        self.assertEqual(fb.bad_crc, 1)
+
+    def test_resync_after_noise(self):
+        fb = FrameBuffer()
+        frames = self.feed(fb, b"\x00\x13\x37" + self.ESCROW + b"\xAA" + self.STACKED)
+        self.assertEqual(frames, [(0x13, b"\x62"), (0x16, b"")])
+        self.assertEqual(fb.dropped, 4)
+
+    def test_false_sync_with_impossible_length(self):
+        fb = FrameBuffer()
+        self.assertEqual(self.feed(fb, bytes((SYNC, 0xFF)) + self.STACKED), [(0x16, b"")])
+
+    def test_false_sync_with_plausible_length(self):
+        # FC 08 annonce 8 octets qui avalent la vraie trame: CRC faux, on repart après le SYNC
+        fb = FrameBuffer()
+        frames = self.feed(fb, bytes((SYNC, 8)) + self.ESCROW + self.STACKED)
+        self.assertEqual(frames, [(0x13, b"\x62"), (0x16, b"")])
+        self.assertEqual(fb.bad_crc, 1)
+
+    def test_frames_split_across_reads(self):
+        fb = FrameBuffer()
+        self.assertEqual(self.feed(fb, self.ESCROW[:4]), [])
+        self.assertEqual(self.feed(fb, self.ESCROW[4:] + self.STACKED[:1]), [(0x13, b"\x62")])
+        self.assertEqual(self.feed(fb, self.STACKED[1:]), [(0x16, b"")])
+
+    def test_small_buffer_compacts_between_reads(self):
+        fb = FrameBuffer(size=16)
+        stream = (self.ESCROW + build_frame(CMD_ACK) + self.STACKED) * 10
+        frames = self.feed(fb, stream, chunk=3)
+        self.assertEqual(len(frames), 30)
+        self.assertEqual(frames[:3], [(0x13, b"\x62"), (CMD_ACK, b""), (0x16, b"")])
+        self.assertEqual((fb.bad_crc, fb.dropped), (0, 0))
+
+
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+PLAIN_STATIC = {"staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"}}
+
+
+@override_settings(CACHES=LOCMEM_CACHE, STORAGES=PLAIN_STATIC)
+class CataloguePageCacheTests(TestCase):
+    """Pages catalogue: servies depuis le cache, invalidées au commit, jamais avec des messages."""
+
+    def setUp(self):
+        cache.clear()
+        cat = Category.objects.create(name="Roses", slug="roses")
+        self.product = Product.objects.create(category=cat, name="Rose rouge", slug="rose", price=500)
+        self.url = reverse("fleur:product_list")
+
+    def get(self):
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        return resp, len(queries)
+
+    def test_second_request_is_a_cache_hit(self):
+        first, n_first = self.get()
+        second, n_second = self.get()
+        self.assertGreater(n_first, 0)
+        self.assertEqual(n_second, 0)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=second["ETag"]).status_code, 304)
+
+    def test_version_bumped_on_commit_only(self):
+        self.get()
+        before = catalogue_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.product.name = "Rose blanche"
+                self.product.save()
+                self.assertEqual(catalogue_version(), before)   # pas encore commité
+        self.assertGreater(catalogue_version(), before)
+        resp, n = self.get()
+        self.assertGreater(n, 0)
+        self.assertContains(resp, "Rose blanche")
+
+    def test_page_with_messages_is_not_cached(self):
+        request = RequestFactory().get(self.url)
+        request.session = {}
+        request._messages = CookieStorage(request)
+        messages.info(request, "Ce slot n'est pas disponible")
+        views.product_list(request)
+        self.assertFalse(hasattr(request, "_catalogue_key"))
+        _, n = self.get()
+        self.assertGreater(n, 0)   # rien n'a été mis en cache par la requête avec message
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class HomeContentSoloTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        HomeContent._solo_memo = None
+
+    def test_rolled_back_save_keeps_the_memo(self):
+        home = HomeContent.get_solo()
+        stamp = cache.get(HomeContent.SOLO_STAMP_KEY)
+        try:
+            with transaction.atomic():
+                edit = HomeContent.get_solo(fresh=True)
+                edit.title = "Annulé"
+                edit.save()
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(cache.get(HomeContent.SOLO_STAMP_KEY), stamp)
+        with self.assertNumQueries(0):
+            self.assertIs(HomeContent.get_solo(), home)
+
+    def test_committed_save_refreshes_the_memo(self):
+        HomeContent.get_solo()
+        with self.captureOnCommitCallbacks(execute=True):
+            edit = HomeContent.get_solo(fresh=True)
+            edit.title = "Nouveau"
+            edit.save()
+        self.assertEqual(HomeContent.get_solo().title, "Nouveau")
+
+
+def import_bridge():
+    """fleur.device_bridge_server, sans créer bridge_outbox.sqlite3 dans le dossier courant."""
+    path = os.path.join(tempfile.mkdtemp(), "outbox.sqlite3")
+    with mock.patch.dict(os.environ, {"OUTBOX_PATH": path, "SIMULATE": "1"}):
+        return importlib.import_module("fleur.device_bridge_server")
+
+
+class RelaySchedulerTests(SimpleTestCase):
+    def wait_jobs(self, sched, job_ids, timeout=3.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            jobs = [sched.job(j) for j in job_ids]
+            if all(j["status"] in ("done", "failed") for j in jobs):
+                return [j["status"] for j in jobs]
+            time.sleep(0.01)
+        self.fail(f"jobs bloqués: {[sched.job(j)['status'] for j in job_ids]}")
+
+    def test_failed_on_write_does_not_strand_the_channel(self):
+        bridge = import_bridge()
+        sched = bridge.RelayScheduler(pulse_ms=20)
+        writes = []
+
+        def write(channel, on):
+            writes.append((channel, on))
+            if on and writes.count((channel, True)) == 2:
+                raise OSError("relay port gone")
+        sched._write = write
+
+        jobs = [sched.submit(3) for _ in range(4)]
+        self.assertEqual(self.wait_jobs(sched, jobs), ["done", "failed", "done", "done"])
+        self.assertIn("relay port gone", sched.job(jobs[1])["error"])
+
+
+class OutboxTests(SimpleTestCase):
+    """File d'attente durable du pont: envoi par lot, repli un par un, lettres mortes."""
+
+    def setUp(self):
+        self.bridge = import_bridge()
+        patcher = mock.patch.object(self.bridge.Outbox, "start_sender")  # on pilote _send à la main
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.outbox = self.bridge.Outbox(os.path.join(tempfile.mkdtemp(), "outbox.sqlite3"))
+
+    def http_error(self, code):
+        response = requests.Response()
+        response.status_code = code
+        return requests.HTTPError(f"{code} Client Error", response=response)
+
+    def send_due(self):
+        self.outbox._send(self.outbox.due(self.bridge.OUTBOX_BATCH))
+
+    def test_enqueue_persists_pending_event(self):
+        event_id = self.outbox.enqueue(7, 1000)
+        self.outbox.start_sender.assert_called_once()
+        self.assertTrue(self.outbox._wake.is_set())
+        (row,) = self.outbox.due(10)
+        self.assertEqual(row[1:], (event_id, 7, 1000, "bill_inserted", 0))
+        self.assertEqual(self.outbox.stats()["pending"], 1)
+
+    def test_batch_results_mark_sent_and_park_rejected(self):
+        ok_id = self.outbox.enqueue(7, 1000)
+        bad_id = self.outbox.enqueue(99, 1000)
+        with mock.patch.object(self.bridge, "post_batch_to_django",
+                               return_value=[{"ok": True}, {"ok": False, "error": "unknown_payment"}]) as post:
+            self.send_due()
+        self.assertEqual([e["event_id"] for e in post.call_args.args[0]], [ok_id, bad_id])
+        self.assertEqual(self.outbox.stats()["pending"], 0)
+        (dead,) = self.outbox.dead_rows()
+        self.assertEqual(dead["event_id"], bad_id)
+        self.assertIn("unknown_payment", dead["last_error"])
+
+    def test_missing_batch_endpoint_falls_back_one_by_one(self):
+        ids = [self.outbox.enqueue(7, 1000), self.outbox.enqueue(7, 2000), self.outbox.enqueue(8, 500)]
+        with mock.patch.object(self.bridge, "post_batch_to_django", side_effect=self.http_error(404)), \
+                mock.patch.object(self.bridge, "post_to_django",
+                                  side_effect=[{"ok": True}, self.http_error(422), {"ok": True}]) as post:
+            self.send_due()
+        self.assertEqual([c.kwargs["event_id"] for c in post.call_args_list], ids)
+        self.assertEqual(self.outbox.stats(), {"pending": 0, "dead": 1, "oldest_pending_s": None})
+        self.assertEqual([r["event_id"] for r in self.outbox.dead_rows()], [ids[1]])
+
+    def test_one_by_one_stops_when_django_unreachable(self):
+        self.outbox.enqueue(7, 1000)
+        self.outbox.enqueue(7, 2000)
+        with mock.patch.object(self.bridge, "post_batch_to_django", side_effect=self.http_error(404)), \
+                mock.patch.object(self.bridge, "post_to_django",
+                                  side_effect=requests.ConnectionError("refused")) as post:
+            self.send_due()
+        post.assert_called_once()
+        # le premier recule (backoff), le second reste dû: rien n'est parqué
+        self.assertEqual(self.outbox.stats()["pending"], 2)
+        self.assertEqual(self.outbox.dead_rows(), [])
+        self.assertEqual(len(self.outbox.due(10)), 1)
+
+    def test_retryable_batch_error_backs_off(self):
+        self.outbox.enqueue(7, 1000)
+        with mock.patch.object(self.bridge, "post_batch_to_django", side_effect=self.http_error(503)):
+            self.send_due()
+        self.assertEqual(self.outbox.due(10), [])
+        self.assertEqual(self.outbox.dead_rows(), [])
+        self.assertGreater(self.outbox.next_due_in(), 0)
+
+    def test_permanent_batch_error_dead_letters_then_requeue(self):
+        first = self.outbox.enqueue(7, 1000)
+        second = self.outbox.enqueue(8, 500)
+        with mock.patch.object(self.bridge, "post_batch_to_django", side_effect=self.http_error(400)):
+            self.send_due()
+        dead = self.outbox.dead_rows()
+        self.assertEqual([r["event_id"] for r in dead], [first, second])
+        self.assertEqual([r["attempts"] for r in dead], [1, 1])
+        self.assertEqual(self.outbox.due(10), [])
+
+        self.outbox._wake.clear()
+        self.assertEqual(self.outbox.requeue_dead([dead[0]["id"]]), 1)
+        self.assertTrue(self.outbox._wake.is_set())
+        self.assertEqual([r[1] for r in self.outbox.due(10)], [first])
+        self.assertEqual(self.outbox.requeue_dead([]), 0)
+        self.assertEqual(self.outbox.requeue_dead(), 1)
+        self.assertEqual(self.outbox.dead_rows(), [])
+
+        with mock.patch.object(self.bridge, "post_batch_to_django",
+                               return_value=[{"ok": True}, {"ok": True}]):
+            self.send_due()
+        self.assertEqual(self.outbox.stats(), {"pending": 0, "dead": 0, "oldest_pending_s": None})
+
+
+@override_settings(STORAGES=PLAIN_STATIC)
+class OrderListTests(TestCase):
+    """Back-office: recherche et pagination par clé (created_at, id) de order_list."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cat = Category.objects.create(name="Roses", slug="roses")
+        product = Product.objects.create(category=cat, name="Rose", slug="rose", price=500)
+        orders = [Order.objects.create(product=product, unit_price=500) for _ in range(7)]
+        # ex-aequo sur created_at: l'id départage
+        same = timezone.now()
+        Order.objects.filter(pk__in=[o.pk for o in orders[2:5]]).update(created_at=same)
+        cls.expected = list(Order.objects.order_by("-created_at", "-id").values_list("pk", flat=True))
+        cls.staff = get_user_model().objects.create_user("staff", password="x", is_staff=True)
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def get(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def test_pages_cover_every_order_once(self):
+        url = reverse("fleur:bo_order_list")
+        seen, pages = [], 0
+        with mock.patch("fleur.views.ORDERS_PAGE_SIZE", 2):
+            while url:
+                resp = self.get(url)
+                seen += [o.pk for o in resp.context["orders"]]
+                pages += 1
+                url = resp.context["next_url"] and reverse("fleur:bo_order_list") + resp.context["next_url"]
+        self.assertEqual(seen, self.expected)
+        self.assertEqual(pages, 4)
+
+    def test_invalid_cursor_restarts_from_the_top(self):
+        resp = self.get(reverse("fleur:bo_order_list") + "?after=n'importe-quoi")
+        self.assertEqual([o.pk for o in resp.context["orders"]], self.expected)
+
+    def test_non_ascii_digits_and_huge_numbers(self):
+        for q in ("²", "٣", "9" * 30):
+            resp = self.get(reverse("fleur:bo_order_list") + "?" + urlencode({"q": q}))
+            self.assertEqual(list(resp.context["orders"]), [])
+
+    def test_numeric_search_finds_the_order(self):
+        resp = self.get(reverse("fleur:bo_order_list") + f"?q={self.expected[3]}")
+        self.assertEqual([o.pk for o in resp.context["orders"]], [self.expected[3]])
+
+
+class VendQueueTests(TestCase):
+    """File VendJob: prise unique, reprise des tâches orphelines, limite d'essais."""
+
+    def setUp(self):
+        cat = Category.objects.create(name="Roses", slug="roses")
+        self.product = Product.objects.create(category=cat, name="Rose", slug="rose", price=500)
+        self.slot = Slot.objects.create(code="A1", product=self.product, quantity=3, relay_channel=4)
+
+    def job(self, **kwargs):
+        order = Order.objects.create(product=self.product, slot=self.slot, unit_price=500)
+        return VendJob.objects.create(order=order, channel=self.slot.relay_channel, **kwargs)
+
+    def test_enqueue_is_idempotent(self):
+        order = Order.objects.create(product=self.product, slot=self.slot, unit_price=500)
+        job = enqueue_vend(order)
+        self.assertEqual((job.channel, job.status), (4, VendJobStatus.QUEUED))
+        self.assertEqual(enqueue_vend(order).pk, job.pk)
+        self.assertEqual(VendJob.objects.count(), 1)
+
+    def test_claim_takes_due_jobs_once_in_order(self):
+        now = timezone.now()
+        later = self.job(run_after=now + timedelta(seconds=30))
+        second = self.job(run_after=now - timedelta(seconds=1))
+        first = self.job(run_after=now - timedelta(seconds=5))
+        claimed = [claim_job(now), claim_job(now), claim_job(now)]
+        self.assertEqual([j and j.pk for j in claimed], [first.pk, second.pk, None])
+        self.assertEqual((claimed[0].status, claimed[0].attempts, claimed[0].locked_at),
+                         (VendJobStatus.RUNNING, 1, now))
+        self.assertEqual(claim_job(now + timedelta(seconds=31)).pk, later.pk)
+
+    def test_claim_uses_skip_locked(self):
+        self.job()
+        with CaptureQueriesContext(connection) as ctx:
+            claim_job()
+        if connection.features.has_select_for_update_skip_locked:
+            self.assertIn("SKIP LOCKED", ctx.captured_queries[0]["sql"])
+        else:
+            self.assertNotIn("FOR UPDATE", ctx.captured_queries[0]["sql"])
+
+    def test_claim_lost_to_another_worker(self):
+        job = self.job()
+        real_first = QuerySet.first
+
+        def first_then_stolen(qs):
+            found = real_first(qs)
+            # un autre worker prend la tâche entre le SELECT et l'UPDATE
+            VendJob.objects.filter(pk=job.pk).update(status=VendJobStatus.RUNNING)
+            return found
+
+        with mock.patch.object(QuerySet, "first", first_then_stolen):
+            self.assertIsNone(claim_job())
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 0)
+
+    def test_requeue_stale_only_touches_old_running_jobs(self):
+        now = timezone.now()
+        stale = self.job(status=VendJobStatus.RUNNING, locked_at=now - timedelta(seconds=120))
+        fresh = self.job(status=VendJobStatus.RUNNING, locked_at=now - timedelta(seconds=5))
+        done = self.job(status=VendJobStatus.DONE, locked_at=now - timedelta(seconds=120))
+        with mock.patch("fleur.vending.VEND_STALE_AFTER", 60):
+            self.assertEqual(requeue_stale(now), 1)
+        statuses = dict(VendJob.objects.values_list("pk", "status"))
+        self.assertEqual([statuses[j.pk] for j in (stale, fresh, done)],
+                         [VendJobStatus.QUEUED, VendJobStatus.RUNNING, VendJobStatus.DONE])
+        self.assertEqual(claim_job(now).pk, stale.pk)
+
+    def test_failures_back_off_then_stop_at_the_limit(self):
+        job = self.job()
+        now = timezone.now()
+        with mock.patch("fleur.vending.VEND_MAX_ATTEMPTS", 3), \
+                mock.patch("fleur.vending.open_slot", side_effect=TimeoutError("relais muet")) as open_slot:
+            results = []
+            for _ in range(3):
+                claimed = claim_job(now)
+                results.append(run_job(claimed))
+                self.assertIsNone(claim_job(now))          # en backoff: pas reprise tout de suite
+                now = VendJob.objects.get(pk=job.pk).run_after
+        self.assertEqual(results, [VendJobStatus.QUEUED, VendJobStatus.QUEUED, VendJobStatus.FAILED])
+        self.assertEqual(open_slot.call_args.args, (4,))
+        self.assertEqual(open_slot.call_args.kwargs, {"key": f"vendjob-{job.pk}"})
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (VendJobStatus.FAILED, 3))
+        self.assertIn("relais muet", job.last_error)
+        self.assertIsNone(claim_job(now + timedelta(hours=1)))
+        self.slot.refresh_from_db()
+        self.assertEqual(self.slot.quantity, 3)
+
+    def test_success_vends_and_decrements_stock_once(self):
+        job = self.job()
+        with mock.patch("fleur.vending.open_slot") as open_slot:
+            self.assertEqual(run_job(claim_job()), VendJobStatus.DONE)
+            VendJob.objects.filter(pk=job.pk).update(status=VendJobStatus.QUEUED)   # rejoué
+            self.assertEqual(run_job(claim_job()), VendJobStatus.DONE)
+        open_slot.assert_called_once()              # déjà servie: pas de seconde impulsion
+        self.slot.refresh_from_db()
+        job.order.refresh_from_db()
+        self.assertEqual(self.slot.quantity, 2)
+        self.assertTrue(job.order.vended)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PaymentLongPollTests(SimpleTestCase):
+    """wait_payment: réveil par notify (local ou tampon partagé) et réponse au timeout."""
+
+    def setUp(self):
+        cache.clear()
+        self.version = 1
+        self.reads = 0
+
+    async def read_state(self):
+        self.reads += 1
+        return self.version, {"amount_inserted": self.version * 500}
+
+    def wait(self, payment_id=1, timeout=5.0, recheck=5.0, since=1, change=None):
+        """Lance wait_payment; `change()` est appelé depuis un autre thread après 50 ms."""
+        async def run():
+            if change is not None:
+                threading.Timer(0.05, change).start()
+            started = time.monotonic()
+            state = await wait_payment(payment_id, self.read_state, since, timeout=timeout, recheck=recheck)
+            return state, time.monotonic() - started
+        return asyncio.run(run())
+
+    def bump(self, payment_id=1, local=True):
+        self.version += 1
+        if local:
+            notify_payment(payment_id)
+        else:   # crédit appliqué par un autre worker: seul le tampon du cache change
+            cache.set(STAMP_KEY.format(payment_id), time.time_ns())
+
+    def test_changed_state_returns_at_once(self):
+        state, elapsed = self.wait(since=0)
+        self.assertEqual(state[0], 1)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(self.reads, 1)
+
+    def test_local_notify_wakes_the_waiter(self):
+        # tampon lu trop rarement pour réveiller à temps: seul l'Event local le peut
+        with mock.patch.object(payment_notify, "LONGPOLL_STAMP_POLL", 10.0):
+            state, elapsed = self.wait(change=self.bump)
+        self.assertEqual(state, (2, {"amount_inserted": 1000}))
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(self.reads, 2)
+        self.assertNotIn(1, payment_notify._waiters)
+
+    def test_stamp_from_another_process_wakes_the_waiter(self):
+        with mock.patch.object(payment_notify, "LONGPOLL_STAMP_POLL", 0.02):
+            state, elapsed = self.wait(change=lambda: self.bump(local=False))
+        self.assertEqual(state[0], 2)
+        self.assertLess(elapsed, 1.0)
+
+    def test_other_payment_does_not_wake_the_waiter(self):
+        with mock.patch.object(payment_notify, "LONGPOLL_STAMP_POLL", 0.02):
+            state, elapsed = self.wait(timeout=0.3, change=lambda: notify_payment(2))
+        self.assertEqual(state[0], 1)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertEqual(self.reads, 2)     # première lecture + celle du timeout
+
+    def test_timeout_returns_current_state(self):
+        with mock.patch.object(payment_notify, "LONGPOLL_STAMP_POLL", 0.02):
+            state, elapsed = self.wait(timeout=0.3, recheck=0.1)
+        self.assertEqual(state[0], 1)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1.5)
+        self.assertGreaterEqual(self.reads, 3)   # relectures de secours toutes les `recheck` s
+        self.assertEqual(payment_notify._waiters, {})
@@ -18,6 +18,8 @@ urlpatterns = [
 
     path("p/<slug:slug>/buy/", views.buy_now, name="buy_now"),
     path("payment/<int:pk>/insert/", views.payment_insert, name="payment_insert"),
+    path("payment/<int:pk>/status/", views.payment_status, name="payment_status"),
+    path("payment/<int:pk>/vend/", views.payment_vend_status, name="payment_vend_status"),
     path("payment/<int:pk>/success/", views.payment_success, name="payment_success"),
     path("payment/<int:pk>/failed/", views.payment_failed, name="payment_failed"),
 
@@ -28,7 +30,7 @@ urlpatterns = [
     # Back-office dashboard & CRUD
     path("backoffice/", views.dashboard, name="bo_dashboard"),
 
-    path("backoffice/products/", views.product_list, name="bo_product_list"),
+    path("backoffice/products/", views.backoffice_product_list, name="bo_product_list"),
     path("backoffice/products/new/", views.product_create, name="bo_product_create"),
 
     path("backoffice/categories/", views.category_list, name="bo_category_list"),
@@ -37,6 +39,7 @@ urlpatterns = [
     path("backoffice/orders/", views.order_list, name="bo_order_list"),
 
     path("api/payment/insert-event/", api.payment_insert_event, name="api_payment_insert_event"),
+    path("api/payment/insert-events/", api.payment_insert_events, name="api_payment_insert_events"),
 
     path("backoffice/slots/", shop.backoffice_slots_list, name="bo_slots_list"),
     path("backoffice/slots/new/", shop.backoffice_slot_create, name="bo_slot_create"),
@@ -0,0 +1,151 @@
+# fleur/vending.py
+"""
+File d'attente des ouvertures de slot (VendJob).
+
+payment_success ne parle plus au bridge: il appelle enqueue_vend() (une seule
+tâche par commande, un rafraîchissement de la page ne relance rien) puis la
+page suit le statut de la tâche. Le worker `python manage.py vend_worker`
+prend les tâches avec claim_job(), appelle /open-slot du bridge, note le
+résultat / les essais et marque la commande servie (Order.vended).
+"""
+import os
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .http_pool import http_client
+from .models import Order, OrderStatus, Slot, VendJob, VendJobStatus
+
+BRIDGE_BASE = os.getenv("BRIDGE_BASE", "http://127.0.0.1:9999")  # device_bridge_server.py
+VEND_MAX_ATTEMPTS = int(os.getenv("VEND_MAX_ATTEMPTS", "5"))
+VEND_BACKOFF_MAX = float(os.getenv("VEND_BACKOFF_MAX", "30"))    # s entre deux essais, au plus
+VEND_STALE_AFTER = float(os.getenv("VEND_STALE_AFTER", "60"))    # s avant de reprendre un job RUNNING orphelin
+OPEN_SLOT_TIMEOUT = 5.0
+RELAY_POLL_S = 0.1
+
+
+def enqueue_vend(order):
+    """
+    Crée (une fois) la tâche d'ouverture de la commande; retourne le VendJob.
+    Une commande déjà servie (p. ex. avant l'arrivée de la file) reçoit une
+    tâche DONE: recharger sa page de succès ne rouvre jamais le casier.
+    """
+    channel = None
+    if order.slot_id:
+        channel = Slot.objects.filter(pk=order.slot_id).values_list("relay_channel", flat=True).first() or 1
+    defaults = {"channel": channel}
+    if order.vended:
+        defaults["status"] = VendJobStatus.DONE
+    job, _ = VendJob.objects.get_or_create(order=order, defaults=defaults)
+    return job
+
+
+def claim_job(now=None):
+    """
+    Prend la prochaine tâche due, ou None. Sur Postgres, skip_locked laisse
+    plusieurs workers se partager la file sans s'attendre; l'UPDATE
+    conditionnel sur le statut garantit qu'une tâche n'est prise qu'une fois
+    même là où SELECT ... FOR UPDATE n'existe pas (SQLite).
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        job = (
+            VendJob.objects.select_for_update(skip_locked=True)
+            .filter(status=VendJobStatus.QUEUED, run_after__lte=now)
+            .order_by("run_after", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        claimed = VendJob.objects.filter(pk=job.pk, status=VendJobStatus.QUEUED).update(
+            status=VendJobStatus.RUNNING, locked_at=now, attempts=F("attempts") + 1, updated_at=now,
+        )
+    if not claimed:
+        return None
+    job.refresh_from_db()
+    return job
+
+
+def requeue_stale(now=None):
+    """Remet en file les tâches RUNNING d'un worker mort (plus de VEND_STALE_AFTER s)."""
+    now = now or timezone.now()
+    return VendJob.objects.filter(
+        status=VendJobStatus.RUNNING, locked_at__lt=now - timedelta(seconds=VEND_STALE_AFTER),
+    ).update(status=VendJobStatus.QUEUED, run_after=now, updated_at=now)
+
+
+def open_slot(channel, key=None):
+    """
+    Demande au bridge l'impulsion du relais puis suit la tâche du bridge
+    (/relay-jobs/<id>) jusqu'à la fin de l'impulsion; lève une exception si
+    l'ouverture n'est pas confirmée. `key` (clé d'idempotence): le bridge
+    renvoie la tâche existante de même clé au lieu de refaire une impulsion,
+    sauf si celle-ci a échoué.
+    """
+    body = {"channel": int(channel)}
+    if key:
+        body["key"] = key
+    r = http_client.post(f"{BRIDGE_BASE}/open-slot", json=body,
+                         timeout=OPEN_SLOT_TIMEOUT, endpoint="open-slot")
+    r.raise_for_status()
+    jr = r.json()
+    if not jr.get("ok"):
+        raise RuntimeError(jr.get("error") or "ouverture non confirmée par le bridge")
+    job_id = jr.get("job_id")
+    deadline = time.monotonic() + OPEN_SLOT_TIMEOUT
+    while job_id and jr.get("status") not in ("done", "failed"):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"relais canal {channel}: impulsion non terminée")
+        time.sleep(RELAY_POLL_S)
+        r = http_client.get(f"{BRIDGE_BASE}/relay-jobs/{job_id}", timeout=OPEN_SLOT_TIMEOUT, endpoint="relay-job")
+        r.raise_for_status()
+        jr = r.json()
+    if jr.get("status") == "failed":
+        raise RuntimeError(jr.get("error") or "relais en échec")
+    return jr
+
+
+def run_job(job):
+    """Exécute une tâche prise par claim_job(); retourne son statut final (ou QUEUED si réessai)."""
+    if job.channel and not Order.objects.filter(pk=job.order_id, vended=True).exists():
+        try:
+            # même clé à chaque essai: un essai après timeout ne redonne pas d'impulsion
+            open_slot(job.channel, key=f"vendjob-{job.pk}")
+        except Exception as e:
+            return _job_failed(job, f"{type(e).__name__}: {e}")
+    _job_done(job)
+    return VendJobStatus.DONE
+
+
+def _job_done(job):
+    # Mark as vended and decrement stock exactly once
+    with transaction.atomic():
+        order = Order.objects.select_for_update().get(pk=job.order_id)
+        if not order.vended:
+            if order.slot_id:
+                slot = Slot.objects.select_for_update().get(pk=order.slot_id)
+                if slot.quantity > 0:
+                    slot.quantity -= 1
+                    slot.save(update_fields=["quantity"])
+            order.vended = True
+            order.status = OrderStatus.PAID
+            order.save(update_fields=["vended", "status"])
+        VendJob.objects.filter(pk=job.pk).update(
+            status=VendJobStatus.DONE, last_error="", locked_at=None, updated_at=timezone.now(),
+        )
+
+
+def _job_failed(job, error):
+    now = timezone.now()
+    if job.attempts >= VEND_MAX_ATTEMPTS:
+        status, run_after = VendJobStatus.FAILED, now
+    else:
+        status = VendJobStatus.QUEUED
+        run_after = now + timedelta(seconds=min(VEND_BACKOFF_MAX, 2 ** (job.attempts - 1)))
+    VendJob.objects.filter(pk=job.pk).update(
+        status=status, run_after=run_after, last_error=error[:255], locked_at=None, updated_at=now,
+    )
+    return status
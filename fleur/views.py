@@ -1,7 +1,7 @@
 # fleur/views.py
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
 from django.contrib import messages
-import requests
+from asgiref.sync import sync_to_async
 from .models import Category, Product, Order, OrderStatus, Payment, PaymentStatus
 from .forms import InsertMoneyForm, SlotForm
 from django.contrib.admin.views.decorators import staff_member_required
@@ -16,9 +16,16 @@ from .forms import HomeContentForm
 from django.http import JsonResponse
 from .forms import InsertMoneyForm  # keep your simple amount form
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse, HttpResponseBadRequest
-from django.db import transaction
-
+from django.http import JsonResponse, HttpResponseNotModified, Http404
+from .payment_notify import notify_payment, wait_payment
+from .models import VendJob
+from .vending import enqueue_vend
+from .catalogue_cache import catalogue_page
+from .search import search_products
+from datetime import datetime
+from urllib.parse import urlencode
+
+@catalogue_page
 def mes_bouquets(request):
     # Only show enabled slots with an active product and quantity > 0
     slots = (
@@ -29,6 +36,7 @@ def mes_bouquets(request):
     )
     return render(request, "fleur/mes_bouquets.html", {"slots": slots})
 
+@catalogue_page
 def home(request):
     content = HomeContent.get_solo()
     ctx = {
@@ -38,6 +46,7 @@ def home(request):
     }
     return render(request, "fleur/home.html", ctx)
 
+@catalogue_page
 def product_list(request, category_slug=None):
     """
     Page publique listant tous les produits actifs.
@@ -55,7 +64,7 @@ def product_list(request, category_slug=None):
 
     q = request.GET.get("q") or ""
     if q:
-        products = products.filter(Q(name__icontains=q) | Q(description__icontains=q))
+        products = search_products(products, q, current_category)   # classés par pertinence
 
     return render(request, "fleur/product_list.html", {
         "categories": categories,
@@ -80,7 +89,7 @@ def buy_now(request, slug):
         slot=slot,
         unit_price=product.price,   # <-- IMPORTANT
         quantity=1,                 # <-- if you track qty
-        status="NEW",
+        status=OrderStatus.PENDING_PAYMENT,
     )
 
     payment = Payment.objects.create(
@@ -92,14 +101,32 @@ def buy_now(request, slug):
     return redirect("fleur:payment_insert", payment.pk)
 
 @require_http_methods(["GET", "POST"])
-def payment_insert(request, pk):
+async def payment_insert(request, pk):
     """
     Payment insert page:
       - UI shows three bill buttons (500/1000/2000) that talk to the local bridge (127.0.0.1:9999/stack).
       - Bridge notifies Django via /api/payment/insert-event/ when a bill is ACTUALLY accepted.
-      - This view serves JSON for polling (?json=1) so the UI updates amount_inserted/remaining.
+      - This view serves JSON for polling (?json=1) so the UI updates amount_inserted/remaining
+        (async ORM, one query; the page itself now uses the payment_status long-poll).
       - POST with 'cancel' marks the order/payment as FAILED and redirects to the failed page.
     """
+    # Live polling endpoint
+    if request.GET.get("json") == "1":
+        state = await _payment_state(pk)
+        if state is None:
+            raise Http404("payment not found")
+        data = state[1]
+        # If already finished, route immediately
+        if data["status"] == PaymentStatus.SUCCEEDED:
+            return redirect("fleur:payment_success", pk)
+        if data["status"] == PaymentStatus.FAILED:
+            return redirect("fleur:payment_failed", pk)
+        return JsonResponse(data)
+
+    # Page HTML / annulation: session, messages et template restent synchrones
+    return await sync_to_async(_payment_insert_page)(request, pk)
+
+def _payment_insert_page(request, pk):
     payment = get_object_or_404(Payment, pk=pk)
     order = payment.order
 
@@ -109,26 +136,13 @@ def payment_insert(request, pk):
     if payment.status == PaymentStatus.FAILED:
         return redirect("fleur:payment_failed", payment.pk)
 
-    # Live polling endpoint
-    if request.GET.get("json") == "1":
-        amount_due = float(payment.amount_due)
-        amount_inserted = float(payment.amount_inserted or 0)
-        return JsonResponse({
-            "amount_due": amount_due,
-            "amount_inserted": amount_inserted,
-            "remaining": max(0.0, amount_due - amount_inserted),
-            "completed": amount_inserted >= amount_due,
-            "status": payment.status,
-            "payment_id": payment.pk,
-            "order_id": order.pk,
-        })
-
     # Cancel flow (annuler)
     if request.method == "POST" and "cancel" in request.POST:
         payment.status = PaymentStatus.FAILED
         order.status = OrderStatus.FAILED
         payment.save(update_fields=["status"])
         order.save(update_fields=["status"])
+        notify_payment(payment.pk)
         messages.warning(request, "Paiement annulé.")
         return redirect("fleur:payment_failed", payment.pk)
 
@@ -140,50 +154,103 @@ def payment_insert(request, pk):
         "remaining": remaining,
     })
 
-BRIDGE_BASE = "http://127.0.0.1:9999"  # device_bridge_server.py
+async def _payment_state(pk):
+    """(version, données JSON) du paiement, en une requête; None s'il n'existe pas."""
+    row = await (
+        Payment.objects.filter(pk=pk)
+        .values("amount_due", "amount_inserted", "status", "order_id")
+        .afirst()
+    )
+    if row is None:
+        return None
+    amount_due = float(row["amount_due"])
+    amount_inserted = float(row["amount_inserted"] or 0)
+    version = f"{row['amount_inserted']}-{row['status']}"
+    return version, {
+        "amount_due": amount_due,
+        "amount_inserted": amount_inserted,
+        "remaining": max(0.0, amount_due - amount_inserted),
+        "completed": row["status"] == PaymentStatus.SUCCEEDED,
+        "status": row["status"],
+        "payment_id": pk,
+        "order_id": row["order_id"],
+        "version": version,
+    }
 
-def payment_success(request, pk):
-    payment = get_object_or_404(Payment, pk=pk)
+@require_http_methods(["GET"])
+async def payment_status(request, pk):
+    """
+    Long-poll du statut de paiement (remplace le polling ?json=1 toutes les 900 ms).
+      - sans ?v= : répond tout de suite avec l'état courant et sa "version"
+      - avec ?v=<version> (ou If-None-Match) : attend que le montant inséré ou le
+        statut change (réveillé par payment_insert_event), sinon 304 au bout
+        de LONGPOLL_TIMEOUT; le client relance alors la même requête.
+    Vue async: sous ASGI une connexion en attente ne coûte pas un thread.
+    """
+    since = request.GET.get("v") or request.headers.get("If-None-Match", "").strip('"') or None
+    if since is None:
+        state = await _payment_state(pk)
+    else:
+        state = await wait_payment(pk, lambda: _payment_state(pk), since)
+    if state is None:
+        return JsonResponse({"ok": False, "error": "payment not found"}, status=404)
+
+    version, data = state
+    resp = HttpResponseNotModified() if version == since else JsonResponse(data)
+    resp["ETag"] = f'"{version}"'
+    resp["Cache-Control"] = "no-store"
+    return resp
+
+async def payment_success(request, pk):
+    """
+    Page de fin de paiement. L'ouverture du slot n'est plus faite ici: la vue
+    met la commande dans la file VendJob (une seule fois, un rafraîchissement
+    ne relance rien) et la page suit la tâche via payment_vend_status; c'est
+    `manage.py vend_worker` qui appelle le bridge et décrémente le stock.
+    """
+    payment = await aget_object_or_404(Payment.objects.select_related("order__product"), pk=pk)
     order = payment.order
 
     if payment.status != PaymentStatus.SUCCEEDED:
         messages.info(request, "Paiement non terminé.")
         return redirect("fleur:payment_insert", payment.pk)
 
-    # If already handled once, just render the page
-    if order.vended:
-        return render(request, "fleur/payment_success.html",
-                      {"payment": payment, "order": order, "product": order.product})
-
-    # Open the physical slot if we have one
-    if order.slot_id:
-        try:
-            slot = Slot.objects.get(pk=order.slot_id)
-            channel = slot.relay_channel or 1
-            # Call the bridge to open the slot
-            r = requests.post(f"{BRIDGE_BASE}/open-slot",
-                              json={"channel": int(channel)}, timeout=3)
-            r.raise_for_status()
-            jr = r.json()
-            if not jr.get("ok"):
-                messages.warning(request, "Ouverture mécanique non confirmée (bridge).")
-        except Exception as e:
-            messages.warning(request, f"Bridge indisponible: {e}")
-
-    # Mark as vended and decrement stock exactly once
-    with transaction.atomic():
-        if not order.vended:
-            if order.slot_id:
-                slot = Slot.objects.select_for_update().get(pk=order.slot_id)
-                if slot.quantity > 0:
-                    slot.quantity -= 1
-                    slot.save(update_fields=["quantity"])
-            order.vended = True
-            order.status = "PAID"
-            order.save(update_fields=["vended", "status"])
-
-    return render(request, "fleur/payment_success.html",
-                  {"payment": payment, "order": order, "product": order.product})
+    job = await sync_to_async(enqueue_vend)(order)
+    return await sync_to_async(render)(request, "fleur/payment_success.html", {
+        "payment": payment, "order": order, "product": order.product, "job": job,
+    })
+
+async def _vend_state(pk):
+    row = await (
+        VendJob.objects.filter(order__payment__pk=pk)
+        .values("status", "attempts", "last_error")
+        .afirst()
+    )
+    if row is None:
+        return None
+    version = f"{row['status']}-{row['attempts']}"
+    return version, {**row, "version": version}
+
+@require_http_methods(["GET"])
+async def payment_vend_status(request, pk):
+    """
+    Long-poll du statut d'ouverture du slot (même protocole que payment_status:
+    ?v=<version>, 304 si rien n'a changé). Le worker tourne dans un autre
+    process: l'attente relit la tâche toutes les secondes.
+    """
+    since = request.GET.get("v") or request.headers.get("If-None-Match", "").strip('"') or None
+    if since is None:
+        state = await _vend_state(pk)
+    else:
+        state = await wait_payment(pk, lambda: _vend_state(pk), since, recheck=1.0)
+    if state is None:
+        return JsonResponse({"ok": False, "error": "vend job not found"}, status=404)
+
+    version, data = state
+    resp = HttpResponseNotModified() if version == since else JsonResponse(data)
+    resp["ETag"] = f'"{version}"'
+    resp["Cache-Control"] = "no-store"
+    return resp
 
 def payment_failed(request, pk):
     payment = get_object_or_404(Payment, pk=pk)
@@ -215,7 +282,7 @@ def dashboard(request):
     return render(request, "backoffice/dashboard.html", {"stats": stats})
 
 @staff_member_required
-def product_list(request):
+def backoffice_product_list(request):
     qs = Product.objects.select_related("category").order_by("name")
     return render(request, "backoffice/product_list.html", {"products": qs})
 
@@ -248,38 +315,93 @@ def category_create(request):
         form = CategoryForm()
     return render(request, "backoffice/category_form.html", {"form": form})
 
+ORDERS_PAGE_SIZE = 50
+
+
+def _order_cursor(order):
+    return f"{order.created_at.isoformat()},{order.pk}"
+
+
+def _parse_order_cursor(value):
+    """'<created_at iso>,<id>' -> (datetime, id), ou None si absent / invalide."""
+    try:
+        created, pk = value.rsplit(",", 1)
+        return datetime.fromisoformat(created), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _merge_order_pages(querysets, limit):
+    """Les `limit` premières commandes de plusieurs requêtes, fusionnées dans l'ordre (created_at, id) décroissant."""
+    if len(querysets) == 1:
+        return list(querysets[0][:limit])
+    rows = {o.pk: o for qs in querysets for o in qs[:limit]}
+    return sorted(rows.values(), key=lambda o: (o.created_at, o.pk), reverse=True)[:limit]
+
+
 @staff_member_required
 def order_list(request):
+    """
+    Pagination par clé (created_at, id) décroissante: chaque page est une
+    lecture d'index bornée par la dernière ligne de la page précédente
+    (?after=...), quel que soit le nombre total de commandes.
+    """
     q = (request.GET.get("q") or "").strip()
     status = (request.GET.get("status") or "").strip()
+    cursor = _parse_order_cursor(request.GET.get("after"))
 
-    orders = Order.objects.select_related("product", "slot").order_by("-id")
-
-    if q:
-        orders = orders.filter(
-            Q(id__icontains=q) |
-            Q(product__name__icontains=q) |
-            Q(slot__code__icontains=q)
-        )
+    orders = Order.objects.select_related("product", "slot").order_by("-created_at", "-id")
     if status:
         orders = orders.filter(status=status)
+    if cursor:
+        created, pk = cursor
+        orders = orders.filter(Q(created_at__lt=created) | Q(created_at=created, pk__lt=pk))
 
-    # distinct list of statuses for filter dropdown
-    statuses = (
-        Order.objects.order_by().values_list("status", flat=True).distinct()
-    )
+    # Chaque recherche = une ou deux lectures d'index sur fleur_order (pas de OR
+    # ni de jointure dans le WHERE, qui font parcourir tout l'index created_at).
+    lookups = [orders]
+    if q:
+        # casiers résolus d'abord (petite table)
+        slot_ids = list(Slot.objects.filter(code__iexact=q).values_list("pk", flat=True))
+        # chiffres ASCII seulement ("²".isdigit() est vrai mais int() échoue),
+        # et pas au-delà d'un entier 64 bits
+        if q.isascii() and q.isdigit() and len(q) <= 18:
+            # n° de commande (clé primaire) et/ou code de casier numérique
+            lookups = [orders.filter(pk=int(q))]
+            if slot_ids:
+                lookups.append(orders.filter(slot_id__in=slot_ids))
+        elif slot_ids:
+            lookups = [orders.filter(slot_id__in=slot_ids)]
+        else:
+            # petit catalogue: on résout les produits d'abord, puis index product_id
+            product_ids = list(Product.objects.filter(name__icontains=q).values_list("pk", flat=True))
+            lookups = [orders.filter(product_id__in=product_ids)]
+
+    page = _merge_order_pages(lookups, ORDERS_PAGE_SIZE + 1)
+    next_url = None
+    if len(page) > ORDERS_PAGE_SIZE:
+        page = page[:ORDERS_PAGE_SIZE]
+        params = {k: v for k, v in (("q", q), ("status", status)) if v}
+        params["after"] = _order_cursor(page[-1])
+        next_url = f"?{urlencode(params)}"
+    first_url = None
+    if cursor:
+        params = {k: v for k, v in (("q", q), ("status", status)) if v}
+        first_url = f"?{urlencode(params)}" if params else "?"
 
     return render(request, "backoffice/order_list.html", {
-        "orders": orders,
+        "orders": page,
         "q": q,
         "status": status,
-        "statuses": statuses,
+        "statuses": OrderStatus.choices,
+        "next_url": next_url,
+        "first_url": first_url,
     })
 
 
 @staff_member_required
 def home_video_edit(request):
-    content = HomeContent.get_solo()
+    content = HomeContent.get_solo(fresh=True)
     if request.method == "POST":
         form = HomeContentForm(request.POST, request.FILES, instance=content)
         if form.is_valid():
@@ -13,4 +13,6 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project_fleur.settings')
 
+# Run under an ASGI server for the async payment views (long-poll payment_status):
+#   uvicorn project_fleur.asgi:application --host 0.0.0.0 --port 8000
 application = get_asgi_application()
@@ -61,6 +61,14 @@ STORAGES = {
 }
 ROOT_URLCONF = 'project_fleur.urls'
 
+# Shared by all workers on the kiosk (catalogue pages, see fleur/catalogue_cache.py)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": BASE_DIR / ".django_cache",
+    }
+}
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",